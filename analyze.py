@@ -14,12 +14,12 @@
 
 from __future__ import division
 from collections import defaultdict
+from itertools import groupby
 from recordclass import recordclass
 
-import re
 import sys
 
-from lib.annotation import Annotation
+from lib.annotation import AnnotationReader
 
 VariationCountInternal = recordclass('VariationCountInternal', ['correct', 'incorrect', 'unmarked'])
 class VariationCount(VariationCountInternal):
@@ -32,6 +32,8 @@ class VariationCount(VariationCountInternal):
     def percent_incorrect(self):
         return self.incorrect / self.annotated_count() * 100
 
+CORRECT, INCORRECT, UNMARKED = range(3)
+
 DEP_FLAG_ARG = ('--dep', '-d')
 LEMMA_FLAG_ARG = ('--lemma', '-l')
 FREQ_FLAG_ARG = ('--frequency', '-f')
@@ -45,75 +47,56 @@ lemma_flag = reduce(lambda acc, arg: acc or arg in LEMMA_FLAG_ARG, sys.argv, Fal
 freq_flag = reduce(lambda acc, arg: acc or arg in FREQ_FLAG_ARG, sys.argv, False)
 all_occ_flag = reduce(lambda acc, arg: acc or arg in ALL_OCC_ARG, sys.argv, False)
 
-total_count = 0
-annotated_count = 0
+# The occurrences are read one at a time from the file, and since the
+# occurrences of a pair of lemmas all come together, each pair is counted once
+# all of its occurrences are read. Only the counts are kept, so the memory
+# needed does not grow with the size of the file.
+def lemma_groups(reader):
+    return groupby(reader, lambda record: record[0])
+
+# Counts the occurrences of one pair of lemmas as correct, incorrect or
+# unmarked, adding each one to the count of its dependency in by_dep as well if
+# it is given. With all_occ, every occurrence counts as annotated, and the
+# ones that are not marked as correct are incorrect.
+def count_occurrences(records, all_occ, by_dep=None):
+    count = VariationCount(0, 0, 0)
+    for lemma_pair, occ in records:
+        if not all_occ and not occ.is_annotated():
+            field = UNMARKED
+        elif occ.correct_in_corpus():
+            field = CORRECT
+        else:
+            field = INCORRECT
+
+        count[field] += 1
+        if by_dep is not None:
+            by_dep[occ.dep][field] += 1
+
+    return count
 
 filename = sys.argv[1]
-ann = Annotation()
-ann.from_filename(filename)
+reader = AnnotationReader(filename)
 
 inconsistent_tokens = 0
 total_tokens = 0
 
-counted_lemma_incorrect = False
-counted_lemma = False
 inconsistent_lemmas = 0
 annotated_lemmas = 0
 
 by_dep = defaultdict(lambda: VariationCount(0, 0, 0))
-by_lemma = defaultdict(lambda: VariationCount(0, 0, 0))
 freqs = defaultdict(int)
 
-for lemma_pair, occurrences in ann.annotations.items():
-    counted_lemma_incorrect = False
-    counted_lemma = False
-
-    num_annotated = 0
-    for occ in occurrences:
-        if not all_occ_flag:
-            if occ.is_annotated():
-                num_annotated += 1
-
-                if not counted_lemma:
-                    counted_lemma = True
-                    annotated_lemmas += 1
-
-                total_tokens += 1
-
-                if occ.correct_in_corpus():
-                    by_dep[occ.dep].correct += 1
-                    by_lemma[lemma_pair].correct += 1
-                else:
-                    inconsistent_tokens += 1
-                    if not counted_lemma_incorrect:
-                        counted_lemma_incorrect = True
-                        inconsistent_lemmas += 1
-
-                    by_dep[occ.dep].incorrect += 1
-                    by_lemma[lemma_pair].incorrect += 1
-            else:
-                by_dep[occ.dep].unmarked += 1
-                by_lemma[lemma_pair].unmarked += 1
-        else:
-            num_annotated += 1
-
-            if not counted_lemma:
-                counted_lemma = True
-                annotated_lemmas += 1
-
-            total_tokens += 1
+for lemma_pair, records in lemma_groups(reader):
+    count = count_occurrences(records, all_occ_flag, by_dep)
+    num_annotated = count.annotated_count()
 
-            if occ.correct_in_corpus():
-                by_dep[occ.dep].correct += 1
-                by_lemma[lemma_pair].correct += 1
-            else:
-                inconsistent_tokens += 1
-                if not counted_lemma_incorrect:
-                    counted_lemma_incorrect = True
-                    inconsistent_lemmas += 1
+    if num_annotated > 0:
+        annotated_lemmas += 1
+    if count.incorrect > 0:
+        inconsistent_lemmas += 1
 
-                by_dep[occ.dep].incorrect += 1
-                by_lemma[lemma_pair].incorrect += 1
+    total_tokens += num_annotated
+    inconsistent_tokens += count.incorrect
 
     freqs[num_annotated] += 1
 
@@ -138,9 +121,13 @@ if lemma_flag:
 
     print
 
-    for lemmas, count in by_lemma.items():
+    # The counts of each pair of lemmas are only needed for this output, so
+    # they are found in another pass over the file rather than kept.
+    for lemmas, records in lemma_groups(AnnotationReader(filename)):
+        count = count_occurrences(records, all_occ_flag)
         if count.one_marked():
-            lemma1, lemma2 = lemmas
+            # A pair of the same lemma is a set of only one.
+            lemma1, lemma2 = lemmas if len(lemmas) == 2 else tuple(lemmas) * 2
 
             print '{}, {}\t{}\t{}\t{}%'.format(lemma1, lemma2, count.incorrect, count.annotated_count(), count.percent_incorrect())
 
@@ -155,9 +142,9 @@ if freq_flag:
     for num, freq in freqs.items():
         print '{}\t{}'.format(num, freq)
 
-print 'Number of inconsistencies: {}'.format(ann.size)
-print 'Number of which were nil: {}'.format(ann.nils)
-print 'Number of which were context: {}'.format(ann.contexts)
+print 'Number of inconsistencies: {}'.format(reader.size)
+print 'Number of which were nil: {}'.format(reader.nils)
+print 'Number of which were context: {}'.format(reader.contexts)
 
 if total_tokens > 0:
     print 'Percent of all occurences that were correct'
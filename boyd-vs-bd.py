@@ -7,13 +7,17 @@
 # that are in both approaches. This takes as input the Boyd et al output file,
 # and the Big Data output file. The output is the Boyd et al output file, with a
 # 'x ' in front of the line if it the same lines show up in the Big Data method
-# or a '  ' otherwise.
+# or a '  ' otherwise. An occurrence is the same in both if it is on the same
+# lines for the same lemmas. Last, the number of distinct occurrences that are
+# in both outputs, only in the Boyd et al output and only in the Big Data output
+# is given.
 #
 ################################################################################
 
 from __future__ import division
 
 from lib.annotation import Annotation
+from lib.comparison import annotation_index, bd_index
 
 import sys
 
@@ -23,15 +27,15 @@ if len(sys.argv) < 3:
 boyd_output = Annotation()
 boyd_output.from_filename(sys.argv[1])
 
-with open(sys.argv[2], 'r') as f:
-    bd_raw_output = f.read()
+bd_output = bd_index(sys.argv[2])
+joined = annotation_index(boyd_output).join(bd_output)
 
 count = 0
 counted = False
 for lemmas, errors in boyd_output.annotations.items():
     counted = False
     for error in errors:
-        if str(error.line_nums) not in bd_raw_output:
+        if not bd_output.has(lemmas, error.line_nums):
             if not counted:
                 try:
                     print '{}, {}'.format(*lemmas)
@@ -45,3 +49,6 @@ for lemmas, errors in boyd_output.annotations.items():
 print('{} not in both'.format(count))
 print('{} in boyd'.format(boyd_output.size))
 print('{}% in boyd and not bd'.format(count / boyd_output.size))
+print('{} in both'.format(len(joined.both)))
+print('{} only in boyd'.format(len(joined.only_first)))
+print('{} only in bd'.format(len(joined.only_second)))
@@ -14,70 +14,143 @@
 # results sometimes.
 # TODO: Figure out if frozenset is best way to do things.
 
+import cPickle
+import hashlib
 import itertools
+import json
+import marshal
+import multiprocessing
+import os
 import random
+import shutil
+import sqlite3
 import sys
+import tempfile
 
+from array import array
+from bisect import bisect_right
 from collections import defaultdict, namedtuple
 from lib.conll import *
 from lib.options import OptionsProcessor
 
+import numpy
+
 
 LEFT = 'left'
 RIGHT = 'right'
 NIL = 'NIL'
 NIL_RELATION = (NIL, NIL)
 
+# The number of sentences in each shard given to a worker process when the
+# extraction is run with more than one job.
+SHARD_SIZE = 500
+
+# The number of files that variation nuclei are spread over when they do not
+# all fit in memory, and a rough estimate of the memory one occurrence takes up
+# in bytes, which is used to turn a memory budget into a number of occurrences.
+PARTITIONS = 64
+OCCURRENCE_SIZE = 450
+
+# The heuristic flags that can be swept over in matrix mode, in the order they
+# are named in the output files.
+MATRIX_FLAGS = ('h', 'i', 'nn', 'nw')
+
 ContextVariation = namedtuple('ContextVariation', ['words', 'internal_ctx', 'external_ctx', 'head_dep', 'line_numbers'])
 Error = namedtuple('Error', ['words', 'dep', 'line_numbers'])
 
-# Get the external context of the two words in the given sentence as a
-# binary tuple of lemmas. The two words should be in the sentence and
-# word1 appears before word2 in the sentence.
-def calc_external_context(sentence, word1, word2):
-    if sentence.indexes[word1.index] < sentence.indexes[word2.index]:
-        prev = word1
-        after = word2
-    else:
-        prev = word2
-        after = word1
-
-    ctx_index1 = sentence.indexes[prev.index] - 1
-    ctx_index2 = sentence.indexes[after.index] + 1
+# The columns of a sentence that variation nuclei are extracted from. Each is a
+# list with one entry per word, and every entry is an id in the vocabulary of
+# the treebank except for heads and line_nums.
+SentenceColumns = namedtuple('SentenceColumns', ['keys', 'lemmas', 'forms', 'heads', 'deps', 'line_nums'])
 
-    if ctx_index1 > -1:
-        ctx1 = sentence[ctx_index1].lemma
+# Get the external context of the words at positions i and j in a sentence as a
+# binary tuple of lemma ids, where i comes before j. If there is no word before
+# or after the pair then that side of the context is None.
+def calc_external_context(lemmas, i, j):
+    if i > 0:
+        ctx1 = lemmas[i - 1]
     else:
         ctx1 = None
 
-    if ctx_index2 < len(sentence):
-        ctx2 = sentence[ctx_index2].lemma
+    if j + 1 < len(lemmas):
+        ctx2 = lemmas[j + 1]
     else:
         ctx2 = None
 
     return (ctx1, ctx2)
 
-def calc_internal_context(sentence, word1, word2):
-    # Get the list of words including the first word then trim it off.
-    words = sentence[word1.index : word2.index] or sentence[word2.index : word1.index]
-    trimmed = words[1:]
+# The internal context of a pair of words, which is the lemma ids between them,
+# is kept as a span over the lemma ids of the sentence rather than a copy of
+# them. A span is a tuple of the rolling hash of the lemma ids in it, where it
+# starts and ends, and the list of lemma ids of the sentence. Plain tuples are
+# the cheapest to make, so that is what is kept in each ContextVariation.
+# Gets the lemma ids in a span as a tuple.
+def span_lemma_ids(span):
+    return tuple(span[3][span[1]:span[2]])
 
-    return map(lambda word: word.lemma, trimmed)
+def span_len(span):
+    return span[2] - span[1]
 
-def valid_tree(filename):
-    size = 0
-    incomplete = 0
+# The lemma ids of a sentence as a list, along with the prefix of their rolling
+# hash, so that the internal context of any pair of its words can be made in
+# constant time.
+class SentenceSpans(object):
+    # The modulus keeps the product of any hash and the base a machine integer.
+    HASH_BASE = 1000003
+    HASH_MODULUS = (1 << 31) - 1
 
-    t = TreeBank()
-    for sentence in t.genr(filename):
-        size += 1
-        if sentence[0].phon == '_' or sentence[0].lemma == '_':
-            incomplete += 1
+    # The powers of the base that have been needed so far.
+    powers = [1]
 
-    if size > 0:
-        return (incomplete / float(size)) < 0.5
-    else:
-        return True
+    def __init__(self, lemmas):
+        self.lemmas = lemmas
+        self.prefix = [0]
+
+        h = 0
+        for lemma in lemmas:
+            h = (h * SentenceSpans.HASH_BASE + lemma + 1) % SentenceSpans.HASH_MODULUS
+            self.prefix.append(h)
+
+        powers = SentenceSpans.powers
+        while len(powers) <= len(lemmas):
+            powers.append(powers[-1] * SentenceSpans.HASH_BASE % SentenceSpans.HASH_MODULUS)
+
+    # Gets the internal context of the words at positions i and j, where i
+    # comes before j.
+    def internal_context(self, i, j):
+        start = i + 1
+        h = (self.prefix[j] - self.prefix[start] * SentenceSpans.powers[j - start]) % SentenceSpans.HASH_MODULUS
+
+        return (h, start, j, self.lemmas)
+
+# Gets a sequence of lemma ids as an internal context of its own.
+def internal_context_of(lemmas):
+    lemmas = list(lemmas)
+    return SentenceSpans(lemmas).internal_context(-1, len(lemmas))
+
+# A pipeline stage that decides if a treebank is complete enough to check. It is
+# not if at least half of its sentences start with a word whose form or lemma
+# is missing.
+class ValidityCheck(object):
+    MISSING = '_'
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self.size = 0
+        self.incomplete = 0
+
+    def consume(self, sentence):
+        self.size += 1
+        if len(sentence) > 0:
+            if self.vocab[sentence.forms[0]] == ValidityCheck.MISSING or \
+               self.vocab[sentence.lemmas[0]] == ValidityCheck.MISSING:
+                self.incomplete += 1
+
+    def valid(self):
+        if self.size > 0:
+            return (self.incomplete / float(self.size)) < 0.5
+        else:
+            return True
 
 def shuffled_dict(d):
     items = d.items()
@@ -85,93 +158,986 @@ def shuffled_dict(d):
     for key, value in items:
         yield key, value
 
-# TODO: This is a long ass method. Should I leave it like this.
-def analyze_tb(filename, use_morph, use_words, use_internal_ctx, no_nil,
-               no_word_order, head_heuristic):
+# Gets the column of a sentence in a ColumnarTreeBank that variation nuclei are
+# keyed on. This is the lemma, form or morphological bundle of each word
+# depending on the options.
+def _key_column(sentence, use_morph, use_words):
+    if use_morph:
+        return sentence.morphs
+    elif use_words:
+        return sentence.forms
+    else:
+        return sentence.lemmas
+
+# Gets the columns of a sentence in a ColumnarTreeBank that are needed to find
+# its variation nuclei as lists.
+def _sentence_columns(sentence, use_morph, use_words):
+    keys = _key_column(sentence, use_morph, use_words)
+    return SentenceColumns(keys.tolist(), sentence.lemmas.tolist(),
+                           sentence.forms.tolist(), sentence.heads.tolist(),
+                           sentence.deps.tolist(), sentence.line_nums.tolist())
+
+def _treebank_columns(tb, use_morph, use_words):
+    for sentence in tb:
+        yield _sentence_columns(sentence, use_morph, use_words)
+
+# Gives the pairs of word positions in a sentence whose nuclei are looked at,
+# in the same order as itertools.combinations. If max_distance is given then
+# only the pairs at most that many words apart are given, along with every head
+# and dependent pair no matter how far apart, so that the number of pairs grows
+# linearly with the length of the sentence rather than quadratically.
+def _sentence_pairs(heads, max_distance=None):
+    n = len(heads)
+    if max_distance is None or max_distance >= n - 1:
+        return itertools.combinations(xrange(n), 2)
+
+    return _window_pairs(heads, max_distance)
+
+def _window_pairs(heads, max_distance):
+    n = len(heads)
+    far = defaultdict(list)
+    for child, head in enumerate(heads):
+        if head >= 0 and abs(head - child) > max_distance:
+            far[min(head, child)].append(max(head, child))
+
+    for i in xrange(n):
+        for j in xrange(i + 1, min(i + max_distance + 1, n)):
+            yield i, j
+
+        if i in far:
+            for j in sorted(set(far[i])):
+                yield i, j
+
+# Finds all the variation nuclei in a sentence and adds them to relations.
+# Every pair of words in the sentence is either related, in which case it is
+# added under its direction and dependency, or it is added as NIL. If
+# related_keys is given then NIL pairs are only added if their keys are in it.
+# If max_distance is given then NIL pairs further apart than that are skipped.
+# Returns the number of occurrences that were added.
+def _extract_sentence(columns, relations, use_internal_ctx, related_keys=None,
+                      max_distance=None):
+    added = 0
+    heads = columns.heads
+    lemmas = columns.lemmas
+
+    # The internal contexts are made here as plain spans rather than through
+    # SentenceSpans.internal_context since this is the innermost loop.
+    spans = SentenceSpans(lemmas)
+    prefix = spans.prefix
+    powers = SentenceSpans.powers
+    index_pairs = _sentence_pairs(heads, max_distance)
+    for i, j in index_pairs:
+        keys = frozenset((columns.keys[i], columns.keys[j]))
+
+        if heads[i] == j:
+            head = j
+            child = i
+        elif heads[j] == i:
+            head = i
+            child = j
+        else:
+            head = None
+            if related_keys is not None and keys not in related_keys:
+                continue
+
+        # Only words that are not next to each other have an internal context,
+        # and the span is only made once it is known to be needed.
+        has_internal_ctx = j - i > 1
+
+        if head is None:
+            if has_internal_ctx:
+                internal_ctx = ((prefix[j] - prefix[i + 1] * powers[j - i - 1]) % SentenceSpans.HASH_MODULUS, i + 1, j, lemmas)
+                external_ctx = calc_external_context(lemmas, i, j)
+                context = ContextVariation((columns.forms[i], columns.forms[j]), internal_ctx, external_ctx, NIL, (columns.line_nums[i], columns.line_nums[j]))
+                relations[keys][NIL_RELATION].append(context)
+                added += 1
+        else:
+            if (use_internal_ctx and has_internal_ctx) or not use_internal_ctx:
+                internal_ctx = ((prefix[j] - prefix[i + 1] * powers[j - i - 1]) % SentenceSpans.HASH_MODULUS, i + 1, j, lemmas)
+                external_ctx = calc_external_context(lemmas, i, j)
+                direction = LEFT if head < child else RIGHT
+                context = ContextVariation((columns.forms[head], columns.forms[child]), internal_ctx, external_ctx, columns.deps[head], (columns.line_nums[head], columns.line_nums[child]))
+
+                relations[keys][(direction, columns.deps[child])].append(context)
+                added += 1
+
+    return added
+
+# Finds the keys of every head and dependent pair in the sentence.
+def _sentence_related_keys(columns):
+    for child, head in enumerate(columns.heads):
+        if head > -1:
+            yield frozenset((columns.keys[head], columns.keys[child]))
+
+# Groups the sentence columns of the treebank into lists of at most size
+# sentences so they can be handed off to worker processes.
+def _shards(columns, size):
+    shard = []
+    for sentence_columns in columns:
+        shard.append(sentence_columns)
+        if len(shard) == size:
+            yield shard
+            shard = []
+
+    if shard:
+        yield shard
+
+# The related keys in a worker process. This is set once when the worker
+# starts rather than sent along with every shard.
+_worker_related_keys = None
+
+def _init_worker(related_keys):
+    global _worker_related_keys
+    _worker_related_keys = related_keys
+
+# Runs func over shards of the given sentence columns in a pool of worker
+# processes and yields the results in treebank order. The sentences are parsed
+# and interned before this so that every worker shares one vocabulary.
+def _imap_shards(func, columns, jobs, related_keys=None):
+    pool = multiprocessing.Pool(jobs, _init_worker, (related_keys,))
+    try:
+        for result in pool.imap(func, _shards(columns, SHARD_SIZE)):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+# An occurrence as a row of ints, which is how occurrences are sent back from
+# worker processes and kept in a ColumnarRelations. A row has the keys in
+# order, where a single key is there twice, the encoded relation, the two
+# words, the internal context as its hash, start and end, the two words of the
+# external context, the relation of the head and the two line numbers. A
+# missing external context and the head relation of a NIL occurrence are -1.
+# The internal context is a span over the lemmas of the whole treebank rather
+# than of one sentence.
+OCCURRENCE_FIELDS = 13
+
+# A relation as one integer, which is twice the relation of the dependent plus
+# one if the head is on the right, or -1 for NIL.
+def _encode_relation(dep):
+    if dep == NIL_RELATION:
+        return -1
+
+    direction, relation = dep
+    return relation * 2 + (direction == RIGHT)
+
+def _decode_relation(code):
+    if code < 0:
+        return NIL_RELATION
+
+    return (RIGHT if code & 1 else LEFT, code >> 1)
+
+# Extracts the variation nuclei of one shard of sentences in a worker process.
+# Each item of the shard is the columns of a sentence and the position of its
+# first word in the treebank. The occurrences are given back as rows of ints,
+# which are much cheaper to send and to take in than ContextVariations.
+def _extract_shard(shard, use_internal_ctx, max_distance=None):
+    rows = array('l')
+    for columns, offset in shard:
+        relations = defaultdict(lambda: defaultdict(list))
+        _extract_sentence(columns, relations, use_internal_ctx,
+                          _worker_related_keys, max_distance)
+
+        for keys, key_variations in relations.items():
+            key1 = min(keys)
+            key2 = max(keys)
+            for dep, variations in key_variations.items():
+                code = _encode_relation(dep)
+                for words, internal_ctx, external_ctx, head_dep, line_numbers in variations:
+                    ext1, ext2 = external_ctx
+                    rows.extend((key1, key2, code, words[0], words[1],
+                                 internal_ctx[0], internal_ctx[1] + offset, internal_ctx[2] + offset,
+                                 -1 if ext1 is None else ext1,
+                                 -1 if ext2 is None else ext2,
+                                 -1 if head_dep == NIL else head_dep,
+                                 line_numbers[0], line_numbers[1]))
+
+    return numpy.frombuffer(rows, dtype=numpy.int_).reshape((-1, OCCURRENCE_FIELDS))
+
+def _related_keys_shard(shard):
+    keys = set()
+    for columns in shard:
+        keys.update(_sentence_related_keys(columns))
+
+    return keys
+
+# Adds relations that were spilled to the running relations. They must be
+# merged in the order they were spilled so that the result is the same as if
+# they were never spilled. Returns the number of occurrences that were added.
+def _merge_relations(relations, partial):
+    added = 0
+    for keys, key_variations in partial.items():
+        for dep, variations in key_variations.items():
+            relations[keys][dep].extend(variations)
+            added += len(variations)
+
+    return added
+
+# The variation nuclei of a treebank spread over partitions on disk by their
+# keys, for when they do not all fit in memory. Relations are spilled into the
+# partitions in treebank order, and each partition can then be read back on its
+# own since no keys are shared between partitions. Only one partition needs to
+# be in memory at a time, which is about the total size over the number of
+# partitions.
+class PartitionedRelations(object):
+    def __init__(self, partitions=PARTITIONS):
+        self.directory = tempfile.mkdtemp(prefix='consistency-')
+        self.paths = [os.path.join(self.directory, str(i)) for i in range(partitions)]
+
+    # Appends the relations to the partition of each of their keys. The
+    # relations are not kept after this so they can be cleared.
+    def spill(self, relations):
+        partitioned = [{} for path in self.paths]
+        for keys, key_variations in relations.items():
+            partitioned[hash(keys) % len(self.paths)][keys] = dict(key_variations)
+
+        for path, partition in zip(self.paths, partitioned):
+            if partition:
+                with open(path, 'ab') as f:
+                    cPickle.dump(partition, f, cPickle.HIGHEST_PROTOCOL)
+
+    # Reads back every partition in turn. Each partition is removed once it has
+    # been read and the directory is removed at the end, or as soon as reading
+    # stops early.
+    def partitions(self):
+        try:
+            for path in self.paths:
+                if not os.path.exists(path):
+                    continue
+
+                relations = defaultdict(lambda: defaultdict(list))
+                with open(path, 'rb') as f:
+                    while True:
+                        try:
+                            _merge_relations(relations, cPickle.load(f))
+                        except EOFError:
+                            break
+
+                os.remove(path)
+                yield relations
+        finally:
+            self.close()
+
+    # Removes the partitions and their directory. This is safe to call more
+    # than once.
+    def close(self):
+        shutil.rmtree(self.directory, True)
+
+# The variation nuclei of a treebank as rows of ints, as they come back from
+# worker processes. They are only made into ContextVariations when errors are
+# looked for. The rows are split by their keys into partitions as they are
+# added, and the errors of each partition are found in a pool of worker
+# processes, so that no work is done for each occurrence in this process. If a
+# budget is given, then once more than that many occurrences are held in memory
+# the partitions are spilled to files, which the workers read back themselves.
+#
+# lemmas is the lemma column of the whole treebank that the internal contexts
+# are spans over, and has to be set before errors are looked for.
+class ColumnarRelations(object):
+    def __init__(self, jobs, budget=None, partitions=PARTITIONS):
+        self.jobs = jobs
+        self.budget = budget
+        self.parts = [[] for i in range(partitions)]
+        self.size = 0
+        self.directory = None
+        self.lemmas = None
+
+    def add(self, rows):
+        n = len(self.parts)
+        part = (rows[:, 0] * SentenceSpans.HASH_BASE + rows[:, 1]) % n
+        order = numpy.argsort(part, kind='mergesort')
+        bounds = numpy.searchsorted(part[order], numpy.arange(n + 1))
+        rows = rows[order]
+        for p in xrange(n):
+            if bounds[p] < bounds[p + 1]:
+                self.parts[p].append(rows[bounds[p]:bounds[p + 1]])
+
+        self.size += len(rows)
+        if self.budget is not None and self.size > self.budget:
+            self.spill()
+
+    # Appends the partitions in memory to their files, one array each.
+    def spill(self):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='consistency-')
+
+        for p, chunks in enumerate(self.parts):
+            if chunks:
+                with open(self._path(p), 'ab') as f:
+                    numpy.save(f, numpy.concatenate(chunks))
+
+        self.parts = [[] for part in self.parts]
+        self.size = 0
+
+    # Gets the rows of partition p from its file and from memory, in the order
+    # they were added.
+    def partition_rows(self, p):
+        chunks = []
+        if self.directory is not None and os.path.exists(self._path(p)):
+            size = os.path.getsize(self._path(p))
+            with open(self._path(p), 'rb') as f:
+                while f.tell() < size:
+                    chunks.append(numpy.load(f))
+        chunks.extend(self.parts[p])
+
+        if not chunks:
+            return numpy.zeros((0, OCCURRENCE_FIELDS), dtype=numpy.int_)
+        return numpy.concatenate(chunks)
+
+    # Finds the errors for each of the given tuples of the arguments of
+    # find_errors that come after the relations. The workers are given the
+    # relations when they start, rather than having them sent, and each one
+    # finds the errors of a partition for every tuple at once.
+    def errors(self, arguments):
+        errors = [{} for args in arguments]
+
+        pool = multiprocessing.Pool(self.jobs, _init_detection, (self,))
+        try:
+            tasks = [(p, arguments) for p in xrange(len(self.parts))]
+            for partition_errors in pool.imap_unordered(_partition_errors, tasks):
+                for args_errors, args_partition_errors in zip(errors, partition_errors):
+                    args_errors.update(args_partition_errors)
+        finally:
+            pool.close()
+            pool.join()
+
+        return errors
+
+    # Removes the spilled partitions. This is safe to call more than once.
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, True)
+
+    def _path(self, p):
+        return os.path.join(self.directory, str(p))
+
+# The ColumnarRelations whose errors are found in a worker process, and the
+# lemmas that its internal contexts are spans over as a list.
+_detection_relations = None
+_detection_lemmas = None
+
+def _init_detection(relations):
+    global _detection_relations, _detection_lemmas
+    _detection_relations = relations
+    _detection_lemmas = relations.lemmas.tolist()
+
+# Leaves out the NIL occurrences that can not be errors, which is most of them.
+# A NIL occurrence is only looked at by find_errors if some related occurrence
+# of the same keys has an internal context with the same hash, and this is
+# found for every row at once.
+def _useful_rows(rows):
+    nil = rows[:, 2] == -1
+    if not nil.any():
+        return rows
+
+    pairs = rows[:, 0] * (rows[:, 1].max() + 1) + rows[:, 1]
+    pair_ids = numpy.unique(pairs, return_inverse=True)[1]
+    contexts = pair_ids * SentenceSpans.HASH_MODULUS + rows[:, 5]
+
+    return rows[~nil | numpy.in1d(contexts, contexts[~nil])]
+
+# Finds the errors of one partition of a ColumnarRelations in a worker process
+# for each tuple of arguments to find_errors. The errors are given back as
+# plain dicts since the defaultdicts can not be pickled.
+def _partition_errors(task):
+    p, arguments = task
+    lemmas = _detection_lemmas
+
     relations = defaultdict(lambda: defaultdict(list))
-    t = TreeBank()
-
-    for sentence in t.genr(filename):
-        index_pairs = itertools.combinations(range(len(sentence.words)), 2)
-        for index_pair in index_pairs:
-            word1 = sentence[index_pair[0]]
-            word2 = sentence[index_pair[1]]
-
-            if use_morph:
-                keys = frozenset((':'.join((word1.pos, word1.features)),
-                                 ':'.join((word2.pos, word2.features))))
-            elif use_words:
-                keys = frozenset((word1.phon, word2.phon))
-            else:
-                keys = frozenset((word1.lemma, word2.lemma))
+    for row in _useful_rows(_detection_relations.partition_rows(p)).tolist():
+        key1, key2, code, word1, word2, h, start, end, ext1, ext2, head_dep, line1, line2 = row
+        context = ContextVariation((word1, word2), (h, start, end, lemmas),
+                                   (None if ext1 == -1 else ext1, None if ext2 == -1 else ext2),
+                                   NIL if head_dep == -1 else head_dep, (line1, line2))
+        relations[frozenset((key1, key2))][_decode_relation(code)].append(context)
+
+    return [dict((keys, dict(key_errors)) for keys, key_errors in find_errors(relations, *args).items())
+            for args in arguments]
+
+# Removes anything that relations keep on disk for the length of a run, which
+# only PartitionedRelations and ColumnarRelations do. This is needed wherever
+# the relations might not be read through to the end, such as when the
+# treebank is not valid.
+def close_relations(relations):
+    if isinstance(relations, (PartitionedRelations, ColumnarRelations)):
+        relations.close()
+
+# A pipeline stage that finds the variation nuclei in every sentence of a
+# ColumnarTreeBank and keeps them in relations. With more than one job, the
+# sentences are grouped into shards that are extracted in worker processes
+# while the rest of the pipeline goes on, and the rows of each shard are added
+# in order to a ColumnarRelations. Otherwise, if a budget is given, then once
+# more than that many occurrences are held in memory they are spilled to disk,
+# and relations is a PartitionedRelations at the end.
+class NucleusExtraction(object):
+    def __init__(self, use_morph, use_words, use_internal_ctx,
+                 related_keys=None, jobs=1, budget=None, max_distance=None):
+        self.use_morph = use_morph
+        self.use_words = use_words
+        self.use_internal_ctx = use_internal_ctx
+        self.related_keys = related_keys
+        self.max_distance = max_distance
+        self.relations = defaultdict(lambda: defaultdict(list))
+
+        self.budget = budget
+        self.size = 0
+        if budget is not None and jobs <= 1:
+            self.partitioned = PartitionedRelations()
+        else:
+            self.partitioned = None
+
+        # The lemmas of every sentence so far, which the internal contexts in
+        # a ColumnarRelations are spans over, and the number of words in them.
+        self.lemmas = []
+        self.tokens = 0
+
+        if jobs > 1:
+            self.relations = ColumnarRelations(jobs, budget)
+            self.pool = multiprocessing.Pool(jobs, _init_worker, (related_keys,))
+        else:
+            self.pool = None
+        self.shard = []
+        self.pending = []
+
+    def consume(self, sentence):
+        columns = _sentence_columns(sentence, self.use_morph, self.use_words)
+        if self.pool is None:
+            self._add(_extract_sentence(columns, self.relations,
+                                        self.use_internal_ctx,
+                                        self.related_keys, self.max_distance))
+        else:
+            self.shard.append((columns, self.tokens))
+            self.lemmas.append(sentence.lemmas)
+            self.tokens += len(sentence)
+            if len(self.shard) == SHARD_SIZE:
+                self._submit()
+
+            # Add the shards that are already done so that their results are
+            # not all held until the end.
+            while self.pending and self.pending[0].ready():
+                self.relations.add(self.pending.pop(0).get())
+
+    def finish(self):
+        if self.pool is not None:
+            if self.shard:
+                self._submit()
 
-            internal_ctx = calc_internal_context(sentence, word1, word2)
-            external_ctx = calc_external_context(sentence, word1, word2)
+            try:
+                for result in self.pending:
+                    self.relations.add(result.get())
+            finally:
+                self.pool.close()
+                self.pool.join()
 
-            if word1.dep_index != word2.index and word2.dep_index != word1.index:
-                if internal_ctx:
-                    context = ContextVariation((word1, word2), internal_ctx, external_ctx, NIL, (word1.line_num, word2.line_num))
-                    relations[keys][NIL_RELATION].append(context)
+            self.pending = []
+            if self.lemmas:
+                self.relations.lemmas = numpy.concatenate(self.lemmas)
             else:
-                if (use_internal_ctx and internal_ctx) or not use_internal_ctx:
-                    if word1.dep_index == word2.index:
-                        head = word2
-                        child = word1
-                    elif word2.dep_index == word1.index:
-                        head = word1
-                        child = word2
+                self.relations.lemmas = numpy.zeros(0, dtype=numpy.int32)
+            self.lemmas = []
 
-                    direction = LEFT if sentence.indexes[head.index] < sentence.indexes[child.index] else RIGHT
-                    context = ContextVariation((head, child), internal_ctx, external_ctx, head.dep, (head.line_num, child.line_num))
+        if self.partitioned is not None:
+            self.partitioned.spill(self.relations)
+            self.relations = self.partitioned
 
-                    relations[keys][(direction, child.dep)].append(context)
+    # Stops the workers and removes the partitions on disk, for when the
+    # extraction can not finish.
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+        if self.partitioned is not None:
+            self.partitioned.close()
+        close_relations(self.relations)
+
+    def _add(self, added):
+        self.size += added
+        if self.partitioned is not None and self.size > self.budget:
+            self.partitioned.spill(self.relations)
+            self.relations = defaultdict(lambda: defaultdict(list))
+            self.size = 0
+
+    def _submit(self):
+        result = self.pool.apply_async(_extract_shard,
+                                       (self.shard, self.use_internal_ctx,
+                                        self.max_distance))
+        self.pending.append(result)
+        self.shard = []
+
+# A hash of the content of a sentence in a ColumnarTreeBank as far as its
+# variation nuclei go. The line numbers are taken relative to the start of the
+# sentence so that a sentence keeps its hash when it moves in the treebank.
+def _sentence_hash(sentence, use_morph, use_words):
+    h = hashlib.sha1()
+    h.update(_key_column(sentence, use_morph, use_words).tobytes())
+    for column in (sentence.lemmas, sentence.forms, sentence.heads, sentence.deps):
+        h.update(column.tobytes())
+    h.update((sentence.line_nums - sentence.line_num).tobytes())
+
+    return h.hexdigest()
+
+# Gets an occurrence as a plain tuple that can be marshalled.
+def _plain_variation(variation):
+    words, internal_ctx, external_ctx, head_dep, line_numbers = variation
+    return (words, span_lemma_ids(internal_ctx), external_ctx, head_dep, line_numbers)
+
+# Reads back the occurrences of a key in a sentence that were stored as plain
+# tuples, with each internal context as a span of its own.
+def _stored_variations(blob):
+    key_variations = {}
+    for dep, variations in marshal.loads(str(blob)).items():
+        key_variations[dep] = [(words, internal_context_of(internal_ctx), external_ctx, head_dep, line_numbers)
+                               for words, internal_ctx, external_ctx, head_dep, line_numbers in variations]
+
+    return key_variations
+
+# Keys are stored in the database as the space separated ids in them.
+def _key_str(keys):
+    return ' '.join(str(key) for key in sorted(keys))
+
+def _str_key(s):
+    return frozenset(int(key) for key in s.split())
+
+# The variation nuclei and errors of a treebank kept from one run to the next,
+# so that a run after the treebank is edited only redoes the work for what
+# changed. They are kept in a database in the cache directory of the treebank,
+# with one database for each set of extraction options.
+#
+# Every sentence is known by a hash of its content, and its occurrences are
+# stored for each of its keys with line numbers relative to the start of the
+# sentence, marshalled as plain tuples. As a pipeline stage, only the sentences
+# whose hash is not stored are extracted. Errors are then only looked for again
+# among the keys of the sentences that were added or removed, and the errors of
+# every other key are kept from the last run. The ids in the database are those
+# of the vocabulary when it is saved, so the stored symbols are interned before
+# anything else.
+class IncrementalRelations(object):
+    STORE_PREFIX = 'incremental-'
+    STORE_SUFFIX = '.db'
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS symbols (id INTEGER PRIMARY KEY, symbol TEXT)',
+        'CREATE TABLE IF NOT EXISTS sentences (hash TEXT PRIMARY KEY)',
+        'CREATE TABLE IF NOT EXISTS occurrences (key TEXT, hash TEXT, relations BLOB)',
+        'CREATE INDEX IF NOT EXISTS occurrences_key ON occurrences (key)',
+        'CREATE INDEX IF NOT EXISTS occurrences_hash ON occurrences (hash)',
+        'CREATE TABLE IF NOT EXISTS errors (key TEXT PRIMARY KEY, errors BLOB)'
+    )
+
+    def __init__(self, filename, use_morph, use_words, use_internal_ctx, no_nil,
+                 vocab, max_distance=None):
+        self.use_morph = use_morph
+        self.use_words = use_words
+        self.use_internal_ctx = use_internal_ctx
+        self.no_nil = no_nil
+        self.vocab = vocab
+        self.max_distance = max_distance
+
+        # NIL occurrences are kept whether or not their keys are related, since
+        # that can change as the treebank is edited.
+        if no_nil:
+            self.related_keys = frozenset()
+        else:
+            self.related_keys = None
+
+        cache_dir = filename + ColumnarTreeBank.CACHE_SUFFIX
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        options = ''.join(str(int(bool(option))) for option in (use_morph, use_words, use_internal_ctx, no_nil))
+        if max_distance is not None:
+            options += '-d{}'.format(max_distance)
+        path = os.path.join(cache_dir, IncrementalRelations.STORE_PREFIX + options + IncrementalRelations.STORE_SUFFIX)
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        for statement in IncrementalRelations.SCHEMA:
+            self.db.execute(statement)
+
+        # If the vocabulary already had other symbols then the stored ids no
+        # longer match and everything has to be redone.
+        self.symbols = 0
+        for i, symbol in self.db.execute('SELECT id, symbol FROM symbols ORDER BY id'):
+            if vocab.intern(symbol) != i:
+                self._clear()
+                self.symbols = 0
+                break
+            self.symbols += 1
+
+        self.stored = set(h for h, in self.db.execute('SELECT hash FROM sentences'))
+
+        # The hash and first line of every sentence in treebank order, the
+        # first lines of the sentences with each hash, and the relations of the
+        # sentences that were not stored.
+        self.hashes = []
+        self.starts = []
+        self.positions = defaultdict(list)
+        self.added = {}
+
+    def consume(self, sentence):
+        h = _sentence_hash(sentence, self.use_morph, self.use_words)
+        start = int(sentence.line_num)
+        self.hashes.append(h)
+        self.starts.append(start)
+        self.positions[h].append(start)
+
+        if h not in self.stored and h not in self.added:
+            columns = _sentence_columns(sentence, self.use_morph, self.use_words)
+            columns = columns._replace(line_nums=[line - start for line in columns.line_nums])
+
+            relations = defaultdict(lambda: defaultdict(list))
+            _extract_sentence(columns, relations, self.use_internal_ctx,
+                              self.related_keys, self.max_distance)
+            self.added[h] = relations
+
+    # Brings the database up to date with the treebank and finds its errors.
+    # This should be called once after every sentence has been consumed.
+    def errors(self, no_word_order, head_heuristic):
+        try:
+            errors = self._update(no_word_order, head_heuristic)
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        finally:
+            self.db.close()
+
+        return errors
+
+    def _update(self, no_word_order, head_heuristic):
+        touched = set()
+        for h in self.stored.difference(self.positions):
+            for key, in self.db.execute('SELECT key FROM occurrences WHERE hash = ?', (h,)):
+                touched.add(_str_key(key))
+            self.db.execute('DELETE FROM occurrences WHERE hash = ?', (h,))
+            self.db.execute('DELETE FROM sentences WHERE hash = ?', (h,))
+
+        for relations in self.added.values():
+            touched.update(relations)
+
+        # The stored errors are only of use if they were found with the same
+        # options, otherwise every key has to be checked again.
+        detection = json.dumps([bool(no_word_order), bool(head_heuristic)])
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'detection'").fetchone()
+        if row is None or row[0] != detection:
+            for key, in self.db.execute('SELECT DISTINCT key FROM occurrences'):
+                touched.add(_str_key(key))
+            self.db.execute('DELETE FROM errors')
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('detection', detection))
+
+        # Gather every occurrence of the touched keys, from the stored sentences
+        # and from the new ones, and place them at the lines of each sentence.
+        relations = defaultdict(lambda: defaultdict(list))
+        if self.stored:
+            for key in touched:
+                for h, blob in self.db.execute('SELECT hash, relations FROM occurrences WHERE key = ?', (_key_str(key),)):
+                    self._place(relations, key, h, _stored_variations(blob))
+
+        for h, sentence_relations in self.added.items():
+            for key, key_variations in sentence_relations.items():
+                self._place(relations, key, h, key_variations)
+
+        self.db.executemany('INSERT INTO sentences VALUES (?)',
+                            ((h,) for h in self.added))
+        self.db.executemany('INSERT INTO occurrences VALUES (?, ?, ?)',
+                            ((_key_str(key), h, sqlite3.Binary(marshal.dumps(dict((dep, map(_plain_variation, variations)) for dep, variations in key_variations.items()))))
+                             for h, sentence_relations in self.added.items()
+                             for key, key_variations in sentence_relations.items()))
+
+        # The errors of the touched keys replace the stored ones, with their
+        # line numbers relative to the sentence they are in.
+        touched_errors = find_errors(relations, self.no_nil, no_word_order,
+                                     head_heuristic)
+        self.db.executemany('DELETE FROM errors WHERE key = ?',
+                            ((_key_str(key),) for key in touched))
+        self.db.executemany('INSERT INTO errors VALUES (?, ?)',
+                            ((_key_str(key), sqlite3.Binary(marshal.dumps(self._relative_errors(key_errors))))
+                             for key, key_errors in touched_errors.items()))
+
+        self.db.executemany('INSERT INTO symbols VALUES (?, ?)',
+                            ((i, self.vocab[i]) for i in xrange(self.symbols, len(self.vocab))))
+
+        errors = defaultdict(lambda: defaultdict(set))
+        for key, blob in self.db.execute('SELECT key, errors FROM errors'):
+            key_errors = errors[_str_key(key)]
+            for (h, words, dep, lines), types in marshal.loads(str(blob)).items():
+                for start in self.positions[h]:
+                    key_errors[Error(words, dep, tuple(start + line for line in lines))].update(types)
+
+        return errors
+
+    # Adds the occurrences of a key in the sentences with hash h to relations.
+    # The occurrences have line numbers relative to the start of the sentence.
+    def _place(self, relations, key, h, key_variations):
+        for start in self.positions[h]:
+            for dep, variations in key_variations.items():
+                relations[key][dep].extend(ContextVariation(words, internal_ctx, external_ctx, head_dep, (start + line1, start + line2))
+                                           for words, internal_ctx, external_ctx, head_dep, (line1, line2) in variations)
+
+    def _relative_errors(self, key_errors):
+        relative = defaultdict(set)
+        for error, types in key_errors.items():
+            i = bisect_right(self.starts, error.line_numbers[0]) - 1
+            start = self.starts[i]
+            lines = tuple(line - start for line in error.line_numbers)
+            relative[(self.hashes[i], error.words, error.dep, lines)].update(types)
+
+        return dict(relative)
+
+    def _clear(self):
+        for table in ('meta', 'symbols', 'sentences', 'occurrences', 'errors'):
+            self.db.execute('DELETE FROM ' + table)
+
+# Finds the set of keys that appear as a head and dependent somewhere in the
+# treebank. A NIL occurrence can only be an error if its keys are related
+# somewhere else, so the NIL occurrences of any other keys never need to be
+# kept.
+def find_related_keys(tb, use_morph, use_words, jobs=1):
+    related_keys = set()
+    columns = _treebank_columns(tb, use_morph, use_words)
+
+    if jobs > 1:
+        for keys in _imap_shards(_related_keys_shard, columns, jobs):
+            related_keys.update(keys)
+    else:
+        for sentence_columns in columns:
+            related_keys.update(_sentence_related_keys(sentence_columns))
+
+    return related_keys
+
+# Gets the printable form of a relation. The dependency of a relation is an id
+# in the vocabulary unless the relation is NIL.
+def relation_str(dep, vocab):
+    if dep == NIL_RELATION:
+        return ', '.join(dep)
+    else:
+        return '{}, {}'.format(dep[0], vocab[dep[1]])
+
+# Finds the variation nuclei of every sentence in the treebank. The treebank
+# is read once, and any extra pipeline stages that are given also consume its
+# sentences in that same pass. The keys, contexts and relations are ids in
+# vocab. If no vocabulary is given then a new one is used. If a budget is given
+# then at most about that many occurrences are held in memory at once, and the
+# rest are kept on disk in a PartitionedRelations. If incremental is set then
+# the result of the last run on the same file is reused through an
+# IncrementalRelations instead, which can not be done for stdin or a pipe. If
+# max_distance is given then words further apart than that are only paired if
+# one is the head of the other.
+def extract_relations(filename, use_morph, use_words, use_internal_ctx, no_nil,
+                      jobs=1, related_only=False, vocab=None, stages=(),
+                      budget=None, incremental=False, max_distance=None):
+    if incremental and is_regular_file(filename):
+        if vocab is None:
+            vocab = Vocabulary()
+
+        relations = IncrementalRelations(filename, use_morph, use_words,
+                                         use_internal_ctx, no_nil, vocab,
+                                         max_distance)
+        tb = ColumnarTreeBank(vocab)
+        tb.from_filename(filename, jobs=jobs)
+        Pipeline(relations, *stages).run(tb)
+
+        return relations
+
+    # The treebank is parsed once into columns, which every later pass over
+    # the sentences reads from.
+    tb = ColumnarTreeBank(vocab)
+    tb.from_filename(filename, jobs=jobs)
+
+    # NIL occurrences are not needed at all if there is no NIL check. If only
+    # the related keys are asked for then an extra pass over the sentences
+    # finds them first, so that no other NIL occurrences are stored.
+    if no_nil:
+        related_keys = frozenset()
+    elif related_only:
+        related_keys = find_related_keys(tb, use_morph, use_words, jobs)
+    else:
+        related_keys = None
+
+    extraction = NucleusExtraction(use_morph, use_words, use_internal_ctx,
+                                   related_keys, jobs, budget, max_distance)
+    try:
+        Pipeline(extraction, *stages).run(tb)
+    except:
+        extraction.close()
+        raise
+
+    return extraction.relations
+
+# TODO: This is a long ass method. Should I leave it like this.
+# Finds the inconsistent occurrences among the variation nuclei. If they were
+# spilled to disk then each partition is checked on its own, and if they are
+# kept from run to run then only the keys that changed are checked. If
+# use_internal_ctx is set then related occurrences without an internal context
+# are left out, which is the same as leaving them out when they are extracted.
+def find_errors(relations, no_nil, no_word_order, head_heuristic,
+                use_internal_ctx=False):
+    if isinstance(relations, IncrementalRelations):
+        return relations.errors(no_word_order, head_heuristic)
+
+    if isinstance(relations, PartitionedRelations):
+        errors = {}
+        try:
+            for partition in relations.partitions():
+                errors.update(find_errors(partition, no_nil, no_word_order,
+                                          head_heuristic, use_internal_ctx))
+        finally:
+            relations.close()
+
+        return errors
+
+    if isinstance(relations, ColumnarRelations):
+        try:
+            errors, = relations.errors([(no_nil, no_word_order, head_heuristic,
+                                         use_internal_ctx)])
+        finally:
+            relations.close()
+
+        return errors
 
     errors = defaultdict(lambda: defaultdict(set))
     for related_keys, key_variations in shuffled_dict(relations):
-        if not no_nil:
+        if not no_nil and NIL_RELATION in key_variations:
             # First check for NIL errors. This is where for a pair of lemmas
             # they appear as NIL in one situation and as related in another
             # and they have the same internal context in both occurences.
-            nil_variations = key_variations[(NIL, NIL)]
-            for nil_variation in nil_variations:
-                for dep, variations in key_variations.items():
-                    if dep != (NIL, NIL):
-                        for variation in variations:
-                            if variation.internal_ctx == nil_variation.internal_ctx:
-                                errors[related_keys][Error(variation.words, dep, variation.line_numbers)].add('nil')
-                                errors[related_keys][Error(nil_variation.words, (NIL, NIL), nil_variation.line_numbers)].add('nil')
+            # The related variations are indexed by the hash of their
+            # internal context so that each NIL variation finds its matches
+            # with a lookup. The matches are then compared by lemma ids, in
+            # case two different contexts have the same hash, once for each
+            # different context.
+            related_ctxs = defaultdict(list)
+            for dep, variations in key_variations.items():
+                if dep != NIL_RELATION:
+                    for variation in variations:
+                        related_ctxs[variation.internal_ctx[0]].append((dep, variation))
+
+            ctx_matches = {}
+            matched_ctxs = set()
+            for nil_variation in key_variations[NIL_RELATION]:
+                candidates = related_ctxs.get(nil_variation.internal_ctx[0])
+                if not candidates:
+                    continue
+
+                internal_ctx = span_lemma_ids(nil_variation.internal_ctx)
+                matches = ctx_matches.get(internal_ctx)
+                if matches is None:
+                    matches = [(dep, variation) for dep, variation in candidates
+                               if span_lemma_ids(variation.internal_ctx) == internal_ctx]
+                    ctx_matches[internal_ctx] = matches
+
+                if matches:
+                    errors[related_keys][Error(nil_variation.words, NIL_RELATION, nil_variation.line_numbers)].add('nil')
+
+                    # The related variations only need to be marked the
+                    # first time their context is matched.
+                    if internal_ctx not in matched_ctxs:
+                        matched_ctxs.add(internal_ctx)
+                        for dep, variation in matches:
+                            errors[related_keys][Error(variation.words, dep, variation.line_numbers)].add('nil')
 
         # Then check for errors using the non-fringe heuristic. This
         # checks between non-NIL relations. If the external contexts
         # of the words are the same then there is most likely an
-        # inconsistency.
-        deps = key_variations.keys()
-        for i, dep1 in enumerate(deps):
-            for dep2 in deps[i + 1:]:
-                if dep1 != (NIL, NIL) and dep2 != (NIL, NIL):
-                    # If word order does not make for an inconsistency, then check
-                    # if the relation type is the same, in which case, do not check
-                    # more for inconsistencies between these dependency types.
-                    if no_word_order and dep1[1] == dep2[1]:
-                        break
-
-                    for variation1 in key_variations[dep1]:
-                        for variation2 in key_variations[dep2]:
-                            # NOTE: The following if statements is for once sent-ids are more common.
-                            # if not((variation1.id > -1 and variation2.id > -1) and (variation1.id == variation2.id)):
-                            if variation1.external_ctx == variation2.external_ctx:
-                                # Lastly, is the check for head dependencies which is on top of the external context.
-                                # TODO: Shorter lines
-                                if head_heuristic:
-                                    if variation1.head_dep == variation2.head_dep:
-                                        errors[related_keys][Error(variation1.words, dep1, variation1.line_numbers)].add('context')
-                                        errors[related_keys][Error(variation2.words, dep2, variation2.line_numbers)].add('context')
-                                else:
-                                    errors[related_keys][Error(variation1.words, dep1, variation1.line_numbers)].add('context')
-                                    errors[related_keys][Error(variation2.words, dep2, variation2.line_numbers)].add('context')
+        # inconsistency. Rather than compare every pair of variations,
+        # they are bucketed by external context, and by the dependency
+        # of the head on top of that with the head heuristic. Only
+        # variations in the same bucket can be inconsistent.
+        buckets = defaultdict(lambda: defaultdict(list))
+        for dep, variations in key_variations.items():
+            if dep != NIL_RELATION:
+                for variation in variations:
+                    if use_internal_ctx and span_len(variation.internal_ctx) == 0:
+                        continue
+
+                    if head_heuristic:
+                        bucket = (variation.external_ctx, variation.head_dep)
+                    else:
+                        bucket = variation.external_ctx
+
+                    buckets[bucket][dep].append(variation)
+
+        for bucket_variations in buckets.values():
+            # If word order does not make for an inconsistency, then the
+            # relations in the bucket must differ in type, not just in
+            # direction.
+            if no_word_order:
+                inconsistent = len(set(dep[1] for dep in bucket_variations)) > 1
+            else:
+                inconsistent = len(bucket_variations) > 1
+
+            if inconsistent:
+                for dep, variations in bucket_variations.items():
+                    for variation in variations:
+                        errors[related_keys][Error(variation.words, dep, variation.line_numbers)].add('context')
 
     return errors
 
+# The keys, contexts and relations of the errors are ids in vocab. If no
+# vocabulary is given then a new one is used.
+def analyze_tb(filename, use_morph, use_words, use_internal_ctx, no_nil,
+               no_word_order, head_heuristic, jobs=1, related_only=False,
+               vocab=None, budget=None, max_distance=None):
+    relations = extract_relations(filename, use_morph, use_words,
+                                  use_internal_ctx, no_nil, jobs, related_only,
+                                  vocab, budget=budget,
+                                  max_distance=max_distance)
+
+    return find_errors(relations, no_nil, no_word_order, head_heuristic)
+
+# Finds the errors for several combinations of the heuristic flags in
+# MATRIX_FLAGS from one set of relations. Each combination is a set of the
+# flags that are on, and the errors are given back for each of them. The
+# relations must be extracted with the internal context and NIL checks on
+# unless they are on in every combination.
+def find_matrix_errors(relations, combinations):
+    def combination_errors(partition, flags):
+        return find_errors(partition, 'nn' in flags, 'nw' in flags,
+                           'h' in flags, 'i' in flags)
+
+    if isinstance(relations, PartitionedRelations):
+        errors = dict((flags, {}) for flags in combinations)
+        try:
+            for partition in relations.partitions():
+                for flags in combinations:
+                    errors[flags].update(combination_errors(partition, flags))
+        finally:
+            relations.close()
+
+        return errors
+    elif isinstance(relations, ColumnarRelations):
+        arguments = [('nn' in flags, 'nw' in flags, 'h' in flags, 'i' in flags)
+                     for flags in combinations]
+        try:
+            return dict(zip(combinations, relations.errors(arguments)))
+        finally:
+            relations.close()
+    else:
+        return dict((flags, combination_errors(relations, flags)) for flags in combinations)
+
+# The name of the output file of a combination of heuristic flags.
+def matrix_filename(prefix, flags):
+    return prefix + ''.join('-' + flag for flag in MATRIX_FLAGS if flag in flags) + '.txt'
+
+# Writes out the errors in the format explained in the README.
+def output_errors(errors, vocab, with_lemmas, f=sys.stdout):
+    for keys, key_errors in errors.items():
+        symbols = [vocab[k] for k in keys]
+        if len(symbols) > 1:
+            print >>f, ', '.join(symbols)
+        else:
+            k, = symbols
+            print >>f, '{}, {}'.format(k, k)
+        for error, types in key_errors.items():
+            dep = relation_str(error.dep, vocab)
+            if with_lemmas:
+                print >>f, '\t{} | {} with ({}, {}) at {}'.format(','.join(types), dep, vocab[error.words[0]], vocab[error.words[1]], error.line_numbers)
+            else:
+                print >>f, '\t{} | {} at {}'.format(','.join(types), dep, error.line_numbers)
+
+        print >>f
+
 
 ######################################################################
 #
@@ -192,8 +1158,15 @@ if __name__ == "__main__":
     op.add_option(('-nn', '--notnil'), 'no_nil')
     op.add_option(('-nw', '--nowordorder'), 'no_word_order')
     op.add_option(('-p', '--morph'), 'morph')
+    op.add_option(('-r', '--related'), 'related_only')
+    op.add_option(('-u', '--incremental'), 'incremental')
     op.add_option(('-w', '--words'), 'words')
     op.add_option(('-wl', '--with-lemmas'), 'with_lemmas')
+    op.add_value_option(('-d', '--distance'), 'distance', 0)
+    op.add_value_option(('-j', '--jobs'), 'jobs', 1)
+    op.add_value_option(('-m', '--memory'), 'memory', 0)
+    op.add_value_option(('-o', '--output'), 'output', 'errors')
+    op.add_value_option(('-x', '--matrix'), 'matrix', '')
 
     op.process(sys.argv)
 
@@ -202,25 +1175,75 @@ if __name__ == "__main__":
     # TODO: Explain why defaultdict
     filename = sys.argv[1]
 
-    if valid_tree(filename):
-        errors = analyze_tb(filename, op.morph_present(), op.words_present(),
-                            op.internal_ctx_present(),
-                            op.no_nil_present(),
-                            op.no_word_order_present(),
-                            op.head_heuristic_present())
-
-        # Print out the error results
-        for keys, key_errors in errors.items():
-            if len(keys) > 1:
-                print ', '.join(keys)
-            else:
-                k, = keys
-                print '{}, {}'.format(k, k)
-            for error, types in key_errors.items():
-                dep = ', '.join(error.dep)
-                if op.with_lemmas_present():
-                    print '\t{} | {} with ({}, {}) at {}'.format(','.join(types), dep, str(error.words[0]), str(error.words[1]), error.line_numbers)
-                else:
-                    print '\t{} | {} at {}'.format(','.join(types), dep, error.line_numbers)
-
-            print
+    # The validity of the treebank is checked in the same pass that extracts
+    # its variation nuclei, and errors are only looked for if it is valid.
+    # A memory budget in megabytes keeps the variation nuclei in partitions on
+    # disk once they take up more than that.
+    memory = int(op.memory_value())
+    if memory > 0:
+        budget = memory * (1 << 20) // OCCURRENCE_SIZE
+    else:
+        budget = None
+
+    # A maximum distance only keeps the pairs of words that are that close
+    # together or related, so long sentences do not give quadratically many.
+    distance = int(op.distance_value())
+    if distance > 0:
+        max_distance = distance
+    else:
+        max_distance = None
+
+    # In matrix mode the nuclei are extracted once and errors are found for
+    # every combination of the heuristic flags that are given, on top of the
+    # ones that are always on. Each combination is written to its own file.
+    flags = frozenset(flag for flag, present in (('h', op.head_heuristic_present()),
+                                                 ('i', op.internal_ctx_present()),
+                                                 ('nn', op.no_nil_present()),
+                                                 ('nw', op.no_word_order_present()))
+                      if present)
+    swept = [flag for flag in op.matrix_value().split(',') if flag]
+    for flag in swept:
+        if flag not in MATRIX_FLAGS:
+            raise ValueError('Unknown matrix flag {}'.format(flag))
+
+    combinations = [flags.union(combination)
+                    for r in range(len(swept) + 1)
+                    for combination in itertools.combinations(swept, r)]
+
+    vocab = Vocabulary()
+    validity = ValidityCheck(vocab)
+    if swept:
+        relations = extract_relations(filename, op.morph_present(),
+                                      op.words_present(), 'i' in flags,
+                                      'nn' in flags, int(op.jobs_value()),
+                                      op.related_only_present(), vocab,
+                                      (validity,), budget,
+                                      max_distance=max_distance)
+
+        try:
+            if validity.valid():
+                errors = find_matrix_errors(relations, combinations)
+                for combination, combination_errors in errors.items():
+                    with open(matrix_filename(op.output_value(), combination), 'w') as f:
+                        output_errors(combination_errors, vocab,
+                                      op.with_lemmas_present(), f)
+        finally:
+            close_relations(relations)
+    else:
+        relations = extract_relations(filename, op.morph_present(),
+                                      op.words_present(),
+                                      op.internal_ctx_present(),
+                                      op.no_nil_present(),
+                                      int(op.jobs_value()),
+                                      op.related_only_present(),
+                                      vocab, (validity,), budget,
+                                      op.incremental_present(), max_distance)
+
+        try:
+            if validity.valid():
+                errors = find_errors(relations, op.no_nil_present(),
+                                     op.no_word_order_present(),
+                                     op.head_heuristic_present())
+                output_errors(errors, vocab, op.with_lemmas_present())
+        finally:
+            close_relations(relations)
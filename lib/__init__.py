@@ -1 +1 @@
-__all__ = ['conll', 'tree', 'annotation']
+__all__ = ['conll', 'tree', 'annotation', 'comparison']
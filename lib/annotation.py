@@ -1,10 +1,13 @@
 import re
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from recordclass import recordclass
 
-AnnotationLineInternal = recordclass('AnnotationLineInternal', ['type', 'dep', 'line_nums', 'ann'])
-class AnnotationLine(AnnotationLineInternal):
+# The methods of an annotated line, whether it is one that can be annotated in
+# place or one that is only read.
+class _LineMethods(object):
+    __slots__ = ()
+
     def is_annotated(self):
         return self.ann is not None
 
@@ -20,52 +23,58 @@ class AnnotationLine(AnnotationLineInternal):
         return output.format(self.type, self.dep[0], self.dep[1],
                              self.line_nums, self.ann)
 
+AnnotationLineInternal = recordclass('AnnotationLineInternal', ['type', 'dep', 'line_nums', 'ann'])
+class AnnotationLine(_LineMethods, AnnotationLineInternal):
+    pass
+
+# An occurrence as it is read by an AnnotationReader. It is immutable and so is
+# cheaper to make and throw away than an AnnotationLine.
+OccurrenceInternal = namedtuple('OccurrenceInternal', ['type', 'dep', 'line_nums', 'ann'])
+class Occurrence(_LineMethods, OccurrenceInternal):
+    __slots__ = ()
+
+# The key that a line of the given lemmas is indexed by in an Annotation. The
+# annotation of the line is not a part of it.
+def _line_key(lemmas, l):
+    return (lemmas, l.type, l.dep, l.line_nums)
+
 # TODO: Rename this to be more representative of the class.
 class Annotation(object):
     # A line in the annotation file is a line that can be annotated.
     # Basically this lines that are not headers, lemma pairs or
-    # newlines.
-    LINE_REGEX = '^\t(context|nil) \| (.+) at \((\d+), (\d+)\)(\s+(y|n)\s*)?\n$'
-    EXPLICIT_LINE_REGEX = '^\t(context|nil) \| (.+) at \((\d+), (\d+)\)(\s+(y|n)\s*)?\n$'
+    # newlines. An occurrence that is inconsistent in more than one way has
+    # all of its types separated by commas.
+    LINE_REGEX = '^\t((?:context|nil)(?:,(?:context|nil))*) \| (.+) at \((\d+), (\d+)\)(\s+(y|n)\s*)?\n$'
+    EXPLICIT_LINE_REGEX = '^\t((?:context|nil)(?:,(?:context|nil))*) \| (.+) at \((\d+), (\d+)\)(\s+(y|n)\s*)?\n$'
+    LINE_PATTERN = re.compile(LINE_REGEX)
     CONTEXT_INCONS = 'context'
     NIL_INCONS = 'nil'
 
+    # Every line is also indexed by its lemmas, type, dependency and line
+    # numbers, so that finding a line takes constant time rather than a scan
+    # over the lines of its lemmas. Only the first of identical lines is in
+    # the index, which is the one a scan would find.
     def __init__(self):
         self.annotations = defaultdict(list)
+        self.index = {}
         self.lemmas = 0
         self.size = 0
         self.nils = 0
         self.contexts = 0
 
     def from_filename(self, filename):
-        with open(filename, 'r') as f:
-            cur_header = None
-            cur_lemmas = None
+        reader = AnnotationReader(filename)
+        for lemmas, occ in reader:
+            self._add_line(lemmas, AnnotationLine(*occ))
 
-            for line in f:
-                m = re.match(Annotation.LINE_REGEX, line)
-                if m:
-                    dep_t = tuple(m.group(2).split(', '))
-                    ls_n = (int(m.group(3)), int(m.group(4)))
+        self.lemmas += reader.lemmas
+        self.size += reader.size
+        self.nils += reader.nils
+        self.contexts += reader.contexts
 
-                    line_ann = AnnotationLine(m.group(1), dep_t, ls_n, m.group(5))
-                    self.annotations[cur_lemmas].append(line_ann)
-
-                    if m.group(1) == Annotation.CONTEXT_INCONS:
-                        self.contexts += 1
-                    elif m.group(1) == Annotation.NIL_INCONS:
-                        self.nils += 1
-                    self.size += 1
-                elif line not in ['\n', '\r\n']:
-                    # This line is starting off a pair of lemmas, so split
-                    # it into the two lemmas, ignoring the '\n' in the
-                    # second lemma.
-                    comma = line.index(', ')
-                    first_lemma = line[:comma]
-                    second_lemma = line[comma + 2:-1]
-
-                    cur_lemmas = frozenset((first_lemma, second_lemma))
-                    self.lemmas += 1
+    def _add_line(self, lemmas, l):
+        self.annotations[lemmas].append(l)
+        self.index.setdefault(_line_key(lemmas, l), l)
 
     # Check if this file has a desired line. Provide the set of lemmas as
     # strings and also the provide the AnnotationLine object that represents the
@@ -83,11 +92,7 @@ class Annotation(object):
             l.ann = ann
 
     def _find_line(self, lemmas, l):
-        for line in self.annotations[lemmas]:
-            if line.type == l.type and line.dep == l.dep and line.line_nums == l.line_nums:
-                return line
-
-        return None
+        return self.index.get(_line_key(lemmas, l))
 
     def output(self, filename):
         with open(filename, 'w') as f:
@@ -109,3 +114,48 @@ class Annotation(object):
                         f.write(line)
 
                     f.write('\n')
+
+# Reads the occurrences in an annotation file one at a time rather than all at
+# once, so that a file of any size can be gone through in constant memory.
+# Iterating gives the set of lemmas and the Occurrence of every occurrence
+# in the order of the file. The counts of lemma pairs, occurrences, nils and
+# contexts are the same as those of an Annotation, and are kept up to date as
+# the file is read. Only lines that start with a tab can be occurrences, so
+# the others are never matched against the pattern.
+class AnnotationReader(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.lemmas = 0
+        self.size = 0
+        self.nils = 0
+        self.contexts = 0
+
+    def __iter__(self):
+        pattern = Annotation.LINE_PATTERN
+        with open(self.filename, 'r') as f:
+            cur_lemmas = None
+
+            for line in f:
+                m = pattern.match(line) if line[0] == '\t' else None
+                if m:
+                    dep_t = tuple(m.group(2).split(', '))
+                    ls_n = (int(m.group(3)), int(m.group(4)))
+
+                    types = m.group(1).split(',')
+                    if Annotation.CONTEXT_INCONS in types:
+                        self.contexts += 1
+                    if Annotation.NIL_INCONS in types:
+                        self.nils += 1
+                    self.size += 1
+
+                    yield cur_lemmas, Occurrence(m.group(1), dep_t, ls_n, m.group(5))
+                elif line not in ['\n', '\r\n']:
+                    # This line is starting off a pair of lemmas, so split
+                    # it into the two lemmas, ignoring the '\n' in the
+                    # second lemma.
+                    comma = line.index(', ')
+                    first_lemma = line[:comma]
+                    second_lemma = line[comma + 2:-1]
+
+                    cur_lemmas = frozenset((first_lemma, second_lemma))
+                    self.lemmas += 1
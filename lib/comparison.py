@@ -0,0 +1,99 @@
+################################################################################
+#
+# Indexes of the occurrences that the Boyd et al method in consistency.py and
+# the Big Data method in bd.py find, keyed on the set of keys and the pair of
+# lines of each occurrence. Results of the two methods are compared by looking
+# up the occurrences of one in the index of the other, so a comparison takes
+# time linear in the number of occurrences.
+#
+################################################################################
+
+import re
+
+from collections import namedtuple
+
+# The result of joining two indexes, which is the keys and lines that are in
+# both, the ones only in the first and the ones only in the second.
+Join = namedtuple('Join', ['both', 'only_first', 'only_second'])
+
+class OccurrenceIndex(object):
+    def __init__(self):
+        self.occurrences = {}
+
+    # Adds an occurrence of the keys, which are a frozenset, on the pair of
+    # lines. Any number of occurrences can be on the same keys and lines.
+    def add(self, keys, lines, occurrence=None):
+        self.occurrences.setdefault((keys, tuple(lines)), []).append(occurrence)
+
+    def has(self, keys, lines):
+        return (keys, tuple(lines)) in self.occurrences
+
+    # Joins this index with another one by hashing, where each item of the
+    # result is a tuple of keys and lines.
+    def join(self, other):
+        both = []
+        only_first = []
+        for key in self.occurrences:
+            if key in other.occurrences:
+                both.append(key)
+            else:
+                only_first.append(key)
+
+        only_second = [key for key in other.occurrences if key not in self.occurrences]
+
+        return Join(both, only_first, only_second)
+
+    def __contains__(self, key):
+        return key in self.occurrences
+
+    def __iter__(self):
+        return iter(self.occurrences)
+
+    def __len__(self):
+        return len(self.occurrences)
+
+# Indexes the errors that consistency.find_errors gives back. The keys are ids
+# in the vocabulary of the errors unless vocab is given, in which case they are
+# the symbols of the ids.
+def boyd_index(errors, vocab=None):
+    index = OccurrenceIndex()
+    for keys, key_errors in errors.items():
+        if vocab is not None:
+            keys = frozenset(vocab[k] for k in keys)
+
+        for error in key_errors:
+            index.add(keys, error.line_numbers, error)
+
+    return index
+
+# Indexes the lines of an Annotation, which is read from the output of
+# consistency.py, by their lemmas.
+def annotation_index(annotation):
+    index = OccurrenceIndex()
+    for lemmas, lines in annotation.annotations.items():
+        for line in lines:
+            index.add(lemmas, line.line_nums, line)
+
+    return index
+
+# A line of the output of bd.py that is an occurrence, which starts with a tab,
+# whether the occurrence was also found by consistency.py, and its lines.
+BD_LINE_REGEX = re.compile(r'^\t[x ] \((\d+), (\d+)\)')
+
+# Indexes the occurrences in the output of bd.py. Each occurrence is under the
+# last line before it that is a pair of keys, and the occurrence itself is the
+# line it was read from.
+def bd_index(filename):
+    index = OccurrenceIndex()
+    with open(filename, 'r') as f:
+        keys = None
+        for line in f:
+            m = BD_LINE_REGEX.match(line)
+            if m:
+                index.add(keys, (int(m.group(1)), int(m.group(2))), line)
+            elif line[0] != '\t' and ', ' in line:
+                line = line.rstrip('\r\n')
+                comma = line.index(', ')
+                keys = frozenset((line[:comma], line[comma + 2:]))
+
+    return index
@@ -1,58 +1,301 @@
-from collections import defaultdict
+from array import array
+from bisect import bisect_right
+import bz2
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
+import os
 import re
+import stat
+import subprocess
+import sys
+import threading
+import zlib
 
 from tree import *
 
+import numpy
+
+# lzma is not a part of the python 2 standard library. If it is not installed
+# then xz files are decompressed with the xz command instead.
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
+
+# The position of the last field of a CoNLL-U word line.
+WORD_LAST_FIELD = 9
+
+# The number of bytes in each chunk of a file that is parsed in parallel.
+CHUNK_SIZE = 1 << 22
+
+# The filename that stands for stdin, and the size of the buffer that treebank
+# files are read through.
+STDIN = '-'
+BUFFER_SIZE = 1 << 20
+
+# The magic numbers at the start of compressed files.
+GZIP_MAGIC = '\x1f\x8b'
+BZ2_MAGIC = 'BZh'
+XZ_MAGIC = '\xfd7zXZ\x00'
+
+# Opens a treebank file for reading in binary mode. Files compressed with gzip,
+# bzip2 or xz are detected by their contents and decompressed as they are read,
+# and the filename '-' reads from stdin. The file is only opened once, and its
+# first bytes are peeked at rather than read, so that nothing is lost from
+# stdin or a pipe, which can be compressed as well. Closing the file does not
+# close stdin.
+def open_treebank(filename):
+    if filename == STDIN:
+        f = io.open(os.dup(sys.stdin.fileno()), 'rb', BUFFER_SIZE)
+    else:
+        f = io.open(filename, 'rb', BUFFER_SIZE)
+
+    compression = _magic_compression(f.peek(len(XZ_MAGIC)))
+    if compression == 'gzip':
+        decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        decompressor = bz2.BZ2Decompressor
+    elif compression == 'xz':
+        if lzma is None:
+            return _xz_command(f)
+        decompressor = lzma.LZMADecompressor
+    else:
+        return f
+
+    return io.BufferedReader(_DecompressedStream(f, decompressor), BUFFER_SIZE)
+
+# The kind of compression that a file starting with the given bytes has, or
+# None if it is a plain file.
+def _magic_compression(magic):
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    elif magic.startswith(BZ2_MAGIC):
+        return 'bz2'
+    elif magic.startswith(XZ_MAGIC):
+        return 'xz'
+    else:
+        return None
+
+# The kind of compression of a regular file, or None if it is a plain file.
+def _compression(filename):
+    with io.open(filename, 'rb') as f:
+        return _magic_compression(f.peek(len(XZ_MAGIC)))
+
+# Checks if the file is a regular file. Stdin, pipes and other files that are
+# not regular can only be read once and in order, so they are never seeked,
+# cached or hashed.
+def is_regular_file(filename):
+    if filename == STDIN:
+        return False
+
+    try:
+        return stat.S_ISREG(os.stat(filename).st_mode)
+    except OSError:
+        return False
+
+# Only plain regular files can be read from anywhere by their byte offsets.
+def _seekable(filename):
+    return is_regular_file(filename) and _compression(filename) is None
+
+# A raw stream of the decompressed contents of a file, which is read through
+# the given function that makes a new decompressor. A file can hold several
+# compressed streams one after another, as gzip and bzip2 allow, and each one
+# after the first gets a decompressor of its own.
+class _DecompressedStream(io.RawIOBase):
+    def __init__(self, f, decompressor):
+        self.f = f
+        self.decompressor = decompressor
+        self.current = decompressor()
+        self.pending = ''
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos == len(self.pending):
+            data = self.f.read(BUFFER_SIZE)
+            if not data:
+                return 0
+
+            self.pending = self._decompress(data)
+            self.pos = 0
+
+        n = min(len(b), len(self.pending) - self.pos)
+        b[:n] = self.pending[self.pos:self.pos + n]
+        self.pos += n
+
+        return n
+
+    def _decompress(self, data):
+        output = []
+        while data:
+            try:
+                output.append(self.current.decompress(data))
+            except EOFError:
+                # The last stream ended right at the end of the last data.
+                self.current = self.decompressor()
+                continue
+
+            data = self.current.unused_data
+            if data:
+                self.current = self.decompressor()
+
+        return ''.join(output)
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+        super(_DecompressedStream, self).close()
+
+# Decompresses the file through the xz command. The command is fed from a
+# thread rather than given the file itself, since the first bytes of the file
+# have already been read into its buffer.
+def _xz_command(f):
+    xz = subprocess.Popen(['xz', '--decompress', '--stdout'],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          bufsize=BUFFER_SIZE)
+
+    feeder = threading.Thread(target=_feed, args=(f, xz.stdin))
+    feeder.daemon = True
+    feeder.start()
+
+    return xz.stdout
+
+# Copies the file into the pipe and then closes both. If the pipe is closed
+# first, such as when the output is not read to the end, then the copy stops.
+def _feed(f, pipe):
+    try:
+        block = f.read(BUFFER_SIZE)
+        while block:
+            pipe.write(block)
+            block = f.read(BUFFER_SIZE)
+        pipe.close()
+    except IOError:
+        pass
+    finally:
+        f.close()
+
+# A symbol table for the strings in a treebank. Each distinct lemma, form,
+# morphological bundle and relation is mapped to a small integer the first time
+# it is seen, so that analyses can key on integers rather than strings. Use the
+# vocabulary to get the string for an integer back.
+class Vocabulary(object):
+    def __init__(self):
+        self.ids = {}
+        self.symbols = []
+
+    def intern(self, symbol):
+        try:
+            return self.ids[symbol]
+        except KeyError:
+            i = len(self.symbols)
+            self.ids[symbol] = i
+            self.symbols.append(symbol)
+
+            return i
+
+    def __getitem__(self, i):
+        return self.symbols[i]
+
+    def __len__(self):
+        return len(self.symbols)
+
 # TODO: API for TreeBank is getting a little messy and confusing. Try to clean up.
+# If the TreeBank is given a Vocabulary then the words of every sentence it
+# creates are interned in it.
 class TreeBank(object):
+    def __init__(self, vocab=None):
+        self.vocab = vocab
+
     # Seed a TreeBank object with a filename so that a generator type object can
     # be created. Rather than reading in the whole file and storing it in memory
     # before you iterate through. None of the sentences are stored afterward in
     # the TreeBank.
-    def genr(self, filename):
-        # TODO: Consolidate code between this and from_filename.
-        with open(filename, 'r') as f:
-            lines = []
-            sent_start = 1
-            for i, line in enumerate(f):
-                stripped = line.strip()
-
-                # If the line is not blank then add it to the running
-                # list of lines for the current sentence.
-                if stripped:
-                    lines.append(stripped)
-                else:
-                    # Otherwise, the line is blank and the end of this
-                    # sentence has been reached. So combine the lines
-                    # found for this sentence and create Sentence
-                    # object.
-                    annotation = '\n'.join(lines)
-                    yield Sentence(annotation, sent_start)
-                    sent_start = i + 2
-                    del lines[:]
-
-    def from_filename(self, filename):
+    #
+    # columns is an optional list of the names of the Word fields that are
+    # needed, out of Word.FIELDS. Each line is then only split as far as the
+    # last of those fields, so the words carry every field up to and including
+    # it and none after it, and the rest of the line is never split. The index
+    # of a word is always read and a Vocabulary needs the fields that it
+    # interns.
+    #
+    # The sentences are always parsed in order. Most of the time goes into
+    # making the Sentence and Word objects, which has to happen in this process
+    # for them to be yielded, so use ColumnarTreeBank.from_filename with jobs to
+    # parse in parallel.
+    def genr(self, filename, columns=None):
+        last_field = self._columns_last_field(columns)
+        for lines, sent_start in self._sentence_lines(filename):
+            yield Sentence.from_lines(lines, sent_start, self.vocab, last_field)
+
+    def from_filename(self, filename, columns=None):
         self.sentences = []
 
-        with open(filename, 'r') as f:
-            lines = []
-            sent_start = 1
-            for i, line in enumerate(f):
+        last_field = self._columns_last_field(columns)
+        for lines, sent_start in self._sentence_lines(filename):
+            self.sentences.append(Sentence.from_lines(lines, sent_start, self.vocab, last_field))
+
+    # Counts the sentences and tokens in the file without creating any
+    # Sentence or Word objects. The counts are the same as those from genr, so
+    # the tokens of a sentence are only added once the blank line that ends it
+    # is read.
+    def count(self, filename):
+        sentences = 0
+        tokens = 0
+        sentence_tokens = 0
+
+        with open_treebank(filename) as f:
+            for line in f:
                 stripped = line.strip()
-
-                # If the line is not blank then add it to the running
-                # list of lines for the current sentence.
-                if stripped:
-                    lines.append(stripped)
-                else:
-                    # Otherwise, the line is blank and the end of this
-                    # sentence has been reached. So combine the lines
-                    # found for this sentence and create Sentence
-                    # object.
-                    annotation = '\n'.join(lines)
-                    self.sentences.append(Sentence(annotation, sent_start))
-                    sent_start = i + 2
-                    del lines[:]
+                if not stripped:
+                    sentences += 1
+                    tokens += sentence_tokens
+                    sentence_tokens = 0
+                elif stripped[0] != Sentence.COMMENT_MARKER and \
+                     Sentence.RANGE_MARKER not in stripped.partition(Word.FIELD_DELIMITER)[0]:
+                    sentence_tokens += 1
+
+        return sentences, tokens
+
+    # The position of the last of the given fields in a line, which is how far
+    # each line has to be split.
+    def _columns_last_field(self, columns):
+        if columns is None:
+            return WORD_LAST_FIELD
+
+        columns = set(columns)
+        if self.vocab is not None:
+            columns.update(Word.INTERNED_FIELDS)
+
+        unknown = columns.difference(Word.FIELDS)
+        if unknown:
+            raise ValueError('Unknown columns: {}'.format(', '.join(unknown)))
+
+        return max(Word.FIELDS.index(column) for column in columns)
+
+    # Yields the raw annotation of each sentence in the file along with the
+    # line number the sentence starts on, without creating any Sentence
+    # objects. This is useful when the sentences are parsed somewhere else,
+    # such as in a worker process.
+    def annotations(self, filename):
+        for lines, sent_start in self._sentence_lines(filename):
+            yield '\n'.join(lines), sent_start
+
+    # Yields the stripped lines of each sentence in the file along with the
+    # line number the sentence starts on.
+    def _sentence_lines(self, filename):
+        with open_treebank(filename) as f:
+            for lines, sent_start in _split_sentences(f):
+                yield lines, sent_start
+
+    # Builds a SentenceIndex of the file, which finds any of its sentences by
+    # line number or sent_id without reading the file from the top.
+    def index(self, filename):
+        return SentenceIndex(filename, self.vocab)
 
     def from_string(self, string):
         self.sentences = []
@@ -65,7 +308,7 @@ class TreeBank(object):
 
             if not line:
                 annotation = '\n'.join(lines[start:idx])
-                self.sentences.append(Sentence(annotation, start + 1))
+                self.sentences.append(Sentence(annotation, start + 1, self.vocab))
 
                 start = idx + 1
 
@@ -78,18 +321,420 @@ class TreeBank(object):
     def __getitem__(self, key):
         return self.sentences[key]
 
+# Groups the given lines into the stripped lines of each sentence, along with
+# the line number the sentence starts on. Every line is only stripped once.
+def _split_sentences(f):
+    lines = []
+    sent_start = 1
+    for i, line in enumerate(f):
+        stripped = line.strip()
+
+        # If the line is not blank then add it to the running list of lines
+        # for the current sentence.
+        if stripped:
+            lines.append(stripped)
+        else:
+            # Otherwise, the line is blank and the end of this sentence has
+            # been reached.
+            yield lines, sent_start
+            sent_start = i + 2
+            lines = []
+
+# Splits the file into byte ranges of about size bytes. Every range but the
+# first starts right after a blank line, so that no sentence is split across
+# two ranges.
+def _chunk_ranges(filename, size):
+    file_size = os.path.getsize(filename)
+    starts = [0]
+
+    with open(filename, 'rb') as f:
+        while starts[-1] + size < file_size:
+            # Skip the rest of the line the guess falls in, then move on
+            # to the end of the next blank line.
+            f.seek(starts[-1] + size)
+            f.readline()
+
+            line = f.readline()
+            while line and line.strip():
+                line = f.readline()
+
+            if f.tell() >= file_size:
+                break
+            starts.append(f.tell())
+
+    return zip(starts, starts[1:] + [file_size])
+
+# Parses the sentences in one byte range of a file in a worker process into
+# the columns of a ColumnarTreeBank. The ids in the columns are in a vocabulary
+# of the chunk alone, whose symbols are given back with them, and the line
+# numbers are relative to the start of the range. The number of lines in the
+# range is given back too so that the line numbers can be fixed afterwards.
+def _parse_chunk(chunk):
+    filename, start, end = chunk
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split('\n')
+
+    # The range ends with a newline, which leaves an empty string at the end
+    # that is not a line.
+    if lines and not lines[-1]:
+        lines.pop()
+
+    tb = ColumnarTreeBank()
+    last_field = TreeBank(tb.vocab)._columns_last_field(ColumnarTreeBank.PARSE_COLUMNS)
+    tb.from_sentences(Sentence.from_lines(sentence_lines, sent_start, tb.vocab, last_field)
+                      for sentence_lines, sent_start in _split_sentences(lines))
+
+    columns = dict((name, getattr(tb, name)) for name in
+                   ColumnarTreeBank.TOKEN_COLUMNS + ColumnarTreeBank.SENTENCE_COLUMNS)
+    return columns, tb.vocab.symbols, len(lines)
+
+# A TreeBank that is stored as flat columns of integers rather than as Sentence
+# and Word objects, so that a whole treebank fits in memory at a fraction of the
+# cost. Every token has one entry in each of the token columns. forms, lemmas,
+# morphs and deps are ids in the vocabulary, heads is the position of the head
+# of each token within its sentence or -1 if it has none, and line_nums is the
+# line each token is on. The tokens of the i-th sentence are those from
+# sent_offsets[i] to sent_offsets[i + 1], and sent_lines has the line each
+# sentence starts on.
+#
+# The first time a file is parsed the columns are written to a cache directory
+# next to it, and later loads memory map them instead of parsing the file again.
+# The cache is keyed on the path, size, modification time and content hash of
+# the file, so it is rebuilt whenever the file changes. Stdin and other files
+# that are not regular are never cached.
+class ColumnarTreeBank(object):
+    TOKEN_COLUMNS = ('forms', 'lemmas', 'morphs', 'heads', 'deps', 'line_nums')
+    ID_COLUMNS = ('forms', 'lemmas', 'morphs', 'deps')
+    PARSE_COLUMNS = ('dep_index',)
+    SENTENCE_COLUMNS = ('sent_offsets', 'sent_lines')
+    CACHE_SUFFIX = '.cache'
+    CACHE_META = 'meta.json'
+    CACHE_VOCAB = 'vocab.txt'
+    HASH_BLOCK_SIZE = 1 << 20
+
+    def __init__(self, vocab=None):
+        self.vocab = Vocabulary() if vocab is None else vocab
+
+    def from_filename(self, filename, cache=True, jobs=1):
+        cache = cache and is_regular_file(filename)
+        if cache and self.from_cache(filename):
+            return
+
+        if jobs > 1 and _seekable(filename):
+            self._parallel_parse(filename, jobs)
+        else:
+            t = TreeBank(self.vocab)
+            self.from_sentences(t.genr(filename, ColumnarTreeBank.PARSE_COLUMNS))
+
+        if cache:
+            self._write_cache(filename, filename + ColumnarTreeBank.CACHE_SUFFIX)
+
+    # With more than one job the file is split into chunks at sentence
+    # boundaries that are parsed in a pool of worker processes. Each worker
+    # gives back the columns of its chunk, so all that is left here is to
+    # translate the ids of each chunk into this vocabulary with one lookup
+    # and join the columns. The line numbers in a chunk start from its first
+    # line, so they are moved down by the number of lines in the chunks before
+    # it, and the sentence offsets by the number of tokens before it.
+    # Compressed files, stdin and pipes can not be split, so they are always
+    # parsed in order.
+    def _parallel_parse(self, filename, jobs):
+        chunks = [(filename, start, end)
+                  for start, end in _chunk_ranges(filename, CHUNK_SIZE)]
+        parts = dict((name, []) for name in
+                     ColumnarTreeBank.TOKEN_COLUMNS + ColumnarTreeBank.SENTENCE_COLUMNS)
+        parts['sent_offsets'].append(numpy.zeros(1, dtype=numpy.int32))
+
+        pool = multiprocessing.Pool(jobs)
+        try:
+            line_offset = 0
+            token_offset = 0
+            for columns, symbols, line_count in pool.imap(_parse_chunk, chunks):
+                translation = numpy.array([self.vocab.intern(symbol) for symbol in symbols],
+                                          dtype=numpy.int32)
+                for name in ColumnarTreeBank.ID_COLUMNS:
+                    columns[name] = translation[columns[name]]
+                columns['line_nums'] += line_offset
+                columns['sent_lines'] += line_offset
+                columns['sent_offsets'] = columns['sent_offsets'][1:] + token_offset
+
+                for name, column in columns.items():
+                    parts[name].append(column)
+
+                line_offset += line_count
+                token_offset += len(columns['forms'])
+        finally:
+            pool.terminate()
+            pool.join()
+
+        for name, column_parts in parts.items():
+            setattr(self, name, numpy.concatenate(column_parts).astype(numpy.int32))
+
+    # Builds the columns from Sentence objects whose words have already been
+    # interned in the vocabulary of this TreeBank.
+    def from_sentences(self, sentences):
+        columns = dict((name, array('i')) for name in ColumnarTreeBank.TOKEN_COLUMNS)
+        sent_offsets = array('i', [0])
+        sent_lines = array('i')
+
+        for sentence in sentences:
+            for word in sentence.words:
+                columns['forms'].append(word.phon_id)
+                columns['lemmas'].append(word.lemma_id)
+                columns['morphs'].append(word.morph_id)
+                columns['heads'].append(sentence.indexes.get(word.dep_index, -1))
+                columns['deps'].append(word.dep_id)
+                columns['line_nums'].append(word.line_num)
+
+            sent_offsets.append(len(columns['forms']))
+            sent_lines.append(sentence.line_num)
+
+        for name, column in columns.items():
+            setattr(self, name, numpy.array(column, dtype=numpy.int32))
+        self.sent_offsets = numpy.array(sent_offsets, dtype=numpy.int32)
+        self.sent_lines = numpy.array(sent_lines, dtype=numpy.int32)
+
+    # Loads the columns from the cache of the file if it is still valid. If only
+    # the modification time changed then the content hash decides. Returns if
+    # the cache was used.
+    def from_cache(self, filename):
+        if not is_regular_file(filename):
+            return False
+
+        cache_dir = filename + ColumnarTreeBank.CACHE_SUFFIX
+        try:
+            with open(os.path.join(cache_dir, ColumnarTreeBank.CACHE_META), 'r') as f:
+                meta = json.load(f)
+
+            stat = os.stat(filename)
+            if meta['path'] != os.path.abspath(filename) or meta['size'] != stat.st_size:
+                return False
+
+            if meta['mtime'] != stat.st_mtime:
+                if meta['hash'] != _content_hash(filename):
+                    return False
+
+                meta['mtime'] = stat.st_mtime
+                with open(os.path.join(cache_dir, ColumnarTreeBank.CACHE_META), 'w') as f:
+                    json.dump(meta, f)
+
+            with open(os.path.join(cache_dir, ColumnarTreeBank.CACHE_VOCAB), 'r') as f:
+                symbols = f.read().split('\n')[:-1]
+
+            columns = {}
+            for name in ColumnarTreeBank.TOKEN_COLUMNS + ColumnarTreeBank.SENTENCE_COLUMNS:
+                path = os.path.join(cache_dir, name + '.npy')
+                columns[name] = numpy.load(path, mmap_mode='r')
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+
+        # The cached ids only line up with the vocabulary if its symbols are
+        # interned in the same order. Otherwise the id columns are translated,
+        # which means they are read into memory.
+        translation = numpy.array([self.vocab.intern(symbol) for symbol in symbols],
+                                  dtype=numpy.int32)
+        identity = (translation == numpy.arange(len(symbols))).all()
+        for name, column in columns.items():
+            if name in ColumnarTreeBank.ID_COLUMNS and not identity:
+                column = translation[column]
+            setattr(self, name, column)
+
+        return True
+
+    # Writes the columns and vocabulary to the cache directory. The metadata is
+    # written last so that a partially written cache is never used. If the
+    # cache can not be written then the TreeBank is simply not cached.
+    def _write_cache(self, filename, cache_dir):
+        meta_path = os.path.join(cache_dir, ColumnarTreeBank.CACHE_META)
+
+        try:
+            if os.path.isdir(cache_dir):
+                if os.path.exists(meta_path):
+                    os.remove(meta_path)
+            else:
+                os.makedirs(cache_dir)
+
+            for name in ColumnarTreeBank.TOKEN_COLUMNS + ColumnarTreeBank.SENTENCE_COLUMNS:
+                numpy.save(os.path.join(cache_dir, name + '.npy'), getattr(self, name))
+
+            with open(os.path.join(cache_dir, ColumnarTreeBank.CACHE_VOCAB), 'w') as f:
+                for symbol in self.vocab.symbols:
+                    f.write(symbol + '\n')
+
+            stat = os.stat(filename)
+            meta = {
+                'path': os.path.abspath(filename),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'hash': _content_hash(filename)
+            }
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        except (IOError, OSError):
+            pass
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield ColumnarSentence(self, i)
+
+    def __getitem__(self, key):
+        return ColumnarSentence(self, key)
+
+    def __len__(self):
+        return len(self.sent_lines)
+
+# The SHA-1 digest of the contents of the file.
+def _content_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        block = f.read(ColumnarTreeBank.HASH_BLOCK_SIZE)
+        while block:
+            h.update(block)
+            block = f.read(ColumnarTreeBank.HASH_BLOCK_SIZE)
+
+    return h.hexdigest()
+
+# A lightweight view of one sentence in a ColumnarTreeBank. Each token column of
+# the TreeBank is available as an attribute of the same name that only has the
+# entries for this sentence. No data is copied.
+class ColumnarSentence(object):
+    def __init__(self, tb, i):
+        self.line_num = tb.sent_lines[i]
+        start = tb.sent_offsets[i]
+        stop = tb.sent_offsets[i + 1]
+
+        for name in ColumnarTreeBank.TOKEN_COLUMNS:
+            setattr(self, name, getattr(tb, name)[start:stop])
+
+    def __len__(self):
+        return len(self.forms)
+
+# Feeds every sentence of one pass over a treebank to several stages, so that
+# each of them does not need a pass of its own. A stage is any object with a
+# consume method that takes a sentence. If it also has a finish method then
+# this is called once every sentence has been consumed. The sentences can come
+# from any reader, such as TreeBank.genr or a ColumnarTreeBank.
+class Pipeline(object):
+    def __init__(self, *stages):
+        self.stages = list(stages)
+
+    def add(self, stage):
+        self.stages.append(stage)
+
+    def run(self, sentences):
+        consumers = [stage.consume for stage in self.stages]
+        for sentence in sentences:
+            for consume in consumers:
+                consume(sentence)
+
+        for stage in self.stages:
+            if hasattr(stage, 'finish'):
+                stage.finish()
+
+# An index of the byte offset, first and last line and sent_id of every
+# sentence in a treebank file. The file is memory mapped, so a sentence can be
+# looked up by the number of any of its lines in O(log n) or by its sent_id,
+# and only that sentence is read and parsed. Call close once the index is no
+# longer needed. Compressed files, stdin and pipes can not be indexed.
+class SentenceIndex(object):
+    SENTENCE_ID_MARKER = '# sent_id'
+
+    def __init__(self, filename, vocab=None):
+        if not _seekable(filename):
+            raise ValueError('Only plain treebank files can be indexed')
+
+        self.vocab = vocab
+        self.offsets = array('l')
+        self.ends = array('l')
+        self.first_lines = array('l')
+        self.last_lines = array('l')
+        self.ids = {}
+
+        with open(filename, 'rb') as f:
+            offset = 0
+            in_sentence = False
+            for i, line in enumerate(f):
+                if line.strip():
+                    if not in_sentence:
+                        in_sentence = True
+                        self.offsets.append(offset)
+                        self.first_lines.append(i + 1)
+
+                    if line.startswith(SentenceIndex.SENTENCE_ID_MARKER):
+                        sent_id = line[len(SentenceIndex.SENTENCE_ID_MARKER):].strip(' =\t\r\n')
+                        self.ids[sent_id] = len(self.offsets) - 1
+                elif in_sentence:
+                    in_sentence = False
+                    self.ends.append(offset)
+                    self.last_lines.append(i)
+
+                offset += len(line)
+
+            if in_sentence:
+                self.ends.append(offset)
+                self.last_lines.append(i + 1)
+
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offset else None
+
+    # The Sentence that the given line number is a part of, or None if the
+    # line is not in any sentence.
+    def find_by_line(self, line_num):
+        i = bisect_right(self.first_lines, line_num) - 1
+        if i < 0 or line_num > self.last_lines[i]:
+            return None
+
+        return self[i]
+
+    # The Sentence with the given sent_id, or None if there is no such
+    # sentence.
+    def find_by_id(self, sent_id):
+        i = self.ids.get(sent_id)
+        if i is None:
+            return None
+
+        return self[i]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+    def __getitem__(self, i):
+        text = self.map[self.offsets[i]:self.ends[i]]
+        lines = [line.strip() for line in text.splitlines()]
+        annotation = '\n'.join(line for line in lines if line)
+
+        return Sentence(annotation, self.first_lines[i], self.vocab)
+
+    def __len__(self):
+        return len(self.offsets)
+
 class Sentence(object):
     COMMENT_MARKER = '#'
-    SENTENCE_ID_REGEX = COMMENT_MARKER + ' sent_id = ([a-z]{2}-ud-(dev|train|test)_\d+)'
-    CONTRACTION_REGEX = '^\d+-\d+'
+    SENTENCE_ID_REGEX = re.compile(COMMENT_MARKER + ' sent_id = ([a-z]{2}-ud-(dev|train|test)_\d+)')
+    RANGE_MARKER = '-'
     SENTENCE_TEXT_MARKER = '='
 
-    def __init__(self, annotation, line_num=-1):
+    def __init__(self, annotation, line_num=-1, vocab=None,
+                 last_field=WORD_LAST_FIELD):
+        self._parse(annotation.splitlines(), line_num, vocab, last_field)
+
+    # Creates a Sentence from the list of its stripped, non blank lines. This
+    # saves joining the lines into one annotation only to split them again.
+    @classmethod
+    def from_lines(cls, lines, line_num=-1, vocab=None,
+                   last_field=WORD_LAST_FIELD):
+        sentence = cls.__new__(cls)
+        sentence._parse(lines, line_num, vocab, last_field)
+
+        return sentence
+
+    def _parse(self, lines, line_num, vocab, last_field):
         self.line_num = line_num
         self.words = []
-        self.lines = annotation.splitlines()
+        self.lines = lines
 
-        id_match = re.match(Sentence.SENTENCE_ID_REGEX, self.lines[0])
+        id_match = Sentence.SENTENCE_ID_REGEX.match(self.lines[0])
         if id_match:
             self.id = id_match.group(1)
         else:
@@ -98,13 +743,23 @@ class Sentence(object):
         self.indexes = {}
         word_index = 0
         for i, line in enumerate(self.lines):
-            if self._is_word_line(line):
-                word_line = -1 if line_num == -1 else self.line_num + i
-                w = Word(line, word_line)
-                self.indexes[w.index] = word_index
-                self.words.append(w)
+            # Comments and multiword token ranges are not words, which can be
+            # told from the first character and the index of the line.
+            if line[0] == Sentence.COMMENT_MARKER:
+                continue
+
+            word_line = -1 if line_num == -1 else self.line_num + i
+            w = Word(line, word_line, last_field)
+            if Sentence.RANGE_MARKER in w.index:
+                continue
 
-                word_index += 1
+            if vocab is not None:
+                w.intern(vocab)
+
+            self.indexes[w.index] = word_index
+            self.words.append(w)
+
+            word_index += 1
 
         # This is to handle the cases where the format is different
         # from the French corpus.
@@ -116,9 +771,6 @@ class Sentence(object):
         except:
             self.text = ""
 
-    def _is_word_line(self, line):
-        return line[0] != Sentence.COMMENT_MARKER and not re.match(Sentence.CONTRACTION_REGEX, line)
-
     # Only accepts strings and slice objects for getitem. This is because there
     # are decimal indexes in UD v2. So this is best handled by a string which
     # is mapped to an underlying integer for the word list.
@@ -136,53 +788,102 @@ class Sentence(object):
         return len(self.words)
 
 # A navigable tree created from a provided Sentence object. The
-# sentence's root is the root of this tree. The root's dependents are
-# then the children of the root node and so on. The SentenceTree also
-# actually extends Tree, so look to that for more info, this is just a
-# wrapper around the construction of a tree data structure from a
-# sentence object.
-class SentenceTree(Tree):
+# sentence's first root is the root of this tree, and the positions in the
+# tree are the positions of the words in the sentence. This is an ArrayTree,
+# so look to that for more info, this is just a wrapper around finding the
+# parent of every word from its head. Words whose head is not a word in the
+# sentence, like empty nodes, are not in the tree.
+class SentenceTree(ArrayTree):
+    ROOT_INDEX = '0'
+
     def __init__(self, sentence):
         self.sentence = sentence
-        deps = defaultdict(list)
-        for word in self.sentence:
-            deps[word.dep_index].append(word)
 
-        root = deps['0'][0]
-        super(SentenceTree, self).__init__(root)
+        root = None
+        parents = []
+        for i, word in enumerate(sentence.words):
+            if word.dep_index == SentenceTree.ROOT_INDEX and root is None:
+                root = i
+            parents.append(sentence.indexes.get(word.dep_index, -1))
+
+        super(SentenceTree, self).__init__(parents, root)
+
+    # Gives the word at position p in the tree.
+    def word(self, p):
+        return self.sentence.words[p]
+
+# Gives a property for the field of a Word at the given position in its
+# annotation. The annotation is only split into fields the first time any of
+# these properties is used, and only as far as the last field that was asked
+# for when the Word was made.
+def _lazy_field(i):
+    def get(self):
+        if i > self._last_field:
+            raise AttributeError('{} was not read for this word'.format(Word.FIELDS[i]))
 
-        self._construct_tree(self, deps)
+        if self._fields is None:
+            self._fields = self._split()
 
-    def _construct_tree(self, t, deps):
-        next_children = deps[t.node.index]
+        return self._fields[i]
 
-        for child in next_children:
-            next_t = Tree(child)
-            self._construct_tree(next_t, deps)
-            t.add_children(next_t)
+    return property(get)
 
+# There are a lot of Word objects in a treebank, so they use slots, and only
+# the index of the word is split out of its annotation right away. last_field
+# is the position of the last field that is needed in Word.FIELDS, and the
+# fields after it are not available.
 class Word(object):
     FIELD_DELIMITER = '\t'
     FEATURE_DELIMITER = '|'
+    FIELDS = ('index', 'phon', 'lemma', 'pos', 'xpos', 'features', 'dep_index',
+              'dep', 'deps', 'misc')
+    INTERNED_FIELDS = ('phon', 'lemma', 'pos', 'features', 'dep')
 
-    def __init__(self, annotation, line_num=-1):
-        self.line_num = line_num
-        fields = annotation.split(Word.FIELD_DELIMITER)
-
-        self.index = fields[0]
-        self.phon = fields[1]
-        self.lemma = fields[2]
-        self.pos = fields[3]
-        self.features = fields[5]
-        self.dep_index = fields[6]
-        self.dep = fields[7]
-        self.deps = fields[8]
-        self.misc = fields[9]
+    __slots__ = ('line_num', 'index', '_annotation', '_fields', '_last_field',
+                 'phon_id', 'lemma_id', 'morph_id', 'dep_id')
 
+    def __init__(self, annotation, line_num=-1, last_field=WORD_LAST_FIELD):
+        self.line_num = line_num
+        self.index = annotation.partition(Word.FIELD_DELIMITER)[0]
+        self._annotation = annotation
+        self._fields = None
+        self._last_field = last_field
+
+    def _split(self):
+        return self._annotation.split(Word.FIELD_DELIMITER, self._last_field + 1)
+
+    phon = _lazy_field(1)
+    lemma = _lazy_field(2)
+    pos = _lazy_field(3)
+    features = _lazy_field(5)
+    dep_index = _lazy_field(6)
+    dep = _lazy_field(7)
+    deps = _lazy_field(8)
+    misc = _lazy_field(9)
+
+    # Interns the form, lemma, morphological bundle and relation of this word
+    # in the given vocabulary. The resulting ids are kept on the word.
+    def intern(self, vocab):
+        if self._fields is None:
+            self._fields = self._split()
+        fields = self._fields
+
+        self.phon_id = vocab.intern(fields[1])
+        self.lemma_id = vocab.intern(fields[2])
+        self.morph_id = vocab.intern(':'.join((fields[3], fields[5])))
+        self.dep_id = vocab.intern(fields[7])
+
+    # A word that was read without its form is shown by its index instead.
     def __str__(self):
+        if self._last_field < Word.FIELDS.index('phon'):
+            return self.index
+
         return self.phon
 
+    # Only the fields that were read for the word are shown.
     def __repr__(self):
-        items = [self.index, self.phon, self.lemma, self.pos, self.features,
-                 self.dep_index, self.dep, self.deps, self.misc]
+        names = ('index', 'phon', 'lemma', 'pos', 'features', 'dep_index',
+                 'dep', 'deps', 'misc')
+        items = [getattr(self, name) for name in names
+                 if Word.FIELDS.index(name) <= self._last_field]
         return Word.FIELD_DELIMITER.join(items)
@@ -6,13 +6,17 @@
 # a given field was in the command line arguments given the field.
 #
 # You provide a dictionary of tuples for version of a command line option along
-# with a meta prefix for the method meta_present.
+# with a meta prefix for the method meta_present. Options that take a value,
+# such as '-j 4', are added with add_value_option and their value is available
+# through the method meta_value.
 #
 ################################################################################
 class OptionsProcessor(object):
     def __init__(self):
         self.options = {}
         self.processed = {}
+        self.defaults = {}
+        self.values = {}
 
     # Adds the given option with the meta name provided. Option is assumed
     # to be an iterable type, even if it only has one element. This way there
@@ -23,6 +27,13 @@ class OptionsProcessor(object):
         if meta:
             setattr(self, meta + '_present', lambda: self.present(option))
 
+    # Adds an option that is followed by a value in the command line arguments.
+    # If the option is not present then meta_value gives back the default.
+    def add_value_option(self, option, meta, default=None):
+        self.add_option(option, meta)
+        self.defaults[option] = default
+        setattr(self, meta + '_value', lambda: self.value(option))
+
     # Process the given arguments, and update the internal state. For any call
     # to *_present methods, it is referring to the results of the last process
     # call. Note, that args should be in a list format as given by sys.argv.
@@ -31,5 +42,14 @@ class OptionsProcessor(object):
             p = reduce(lambda found, arg: found or arg in option, args, False)
             self.processed[option] = p
 
+        for option, default in self.defaults.items():
+            self.values[option] = default
+            for i, arg in enumerate(args[:-1]):
+                if arg in option:
+                    self.values[option] = args[i + 1]
+
     def present(self, option):
         return self.processed[option]
+
+    def value(self, option):
+        return self.values[option]
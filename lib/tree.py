@@ -1,5 +1,3 @@
-from itertools import chain, imap
-
 class Tree(object):
     def __init__(self, node):
         self.node = node
@@ -12,46 +10,128 @@ class Tree(object):
             self.children.append(child)
 
     # Returns the subtrees whose root nodes equal the provided node.
-    # If there are no such trees than an empty list is returned.
+    # If there are no such trees than an empty list is returned. The subtrees
+    # of a match are not looked through.
     def find_trees_by_node(self, callback, expected):
         trees = []
 
-        if callback(self.node) == expected:
-            trees.append(self)
-        else:
-            for child in self.children:
-                child_matches = child.find_trees_by_node(callback, expected)
-                if child_matches:
-                    trees += child_matches
+        stack = [self]
+        while stack:
+            t = stack.pop()
+            if callback(t.node) == expected:
+                trees.append(t)
+            else:
+                stack.extend(reversed(t.children))
 
         return trees
 
     # Checks if the given node is in the tree and returns a boolean
     # response. To be used with `in` operator.
     def __contains__(self, value):
-        contains = self.node == value
-        if not contains:
-            for child in self.children:
-                contains = value in child
-
-                if contains:
-                    break
-
-        return contains
+        return any(t.node == value for t in self)
 
+    # Yields every subtree in pre-order. This is done with an explicit stack
+    # rather than recursion so that deep trees do not hit the recursion limit.
     def __iter__(self):
-        yield self
-        # TODO: Look into how this works
-        for child in chain(*imap(iter, self.children)):
-            yield child
+        stack = [self]
+        while stack:
+            t = stack.pop()
+            yield t
+            stack.extend(reversed(t.children))
 
     def size(self):
-        s = 0
+        return sum(1 for t in self if t.node)
+
+# A tree over the positions 0 to n - 1 that is built from an array of the
+# parent of each position, where -1 means no parent. Only root and the
+# positions below it are in the tree. The children of every position are kept
+# in one flat list in position order, where the children of p are
+# children[child_offsets[p]:child_offsets[p + 1]]. Every position in the tree
+# also has a pre-order and post-order number, so that ancestor tests take
+# constant time, and -1 for both if it is not in the tree.
+class ArrayTree(object):
+    def __init__(self, parents, root):
+        n = len(parents)
+        self.parents = parents
+        self.root = root
+
+        # The children are laid out by a counting sort on their parents.
+        counts = [0] * (n + 1)
+        for parent in parents:
+            if parent >= 0:
+                counts[parent + 1] += 1
+        for p in xrange(n):
+            counts[p + 1] += counts[p]
+        self.child_offsets = counts
+
+        self.children = [0] * counts[n]
+        fill = counts[:n]
+        for child, parent in enumerate(parents):
+            if parent >= 0:
+                self.children[fill[parent]] = child
+                fill[parent] += 1
+
+        self.pre = [-1] * n
+        self.post = [-1] * n
+        self.order = []
+        if root is not None:
+            self._number(root)
 
-        if self.node:
-            s += 1
+    # Numbers the positions below root in pre-order and post-order with an
+    # explicit stack. Each entry on the stack is a position and the offset of
+    # its next child to visit.
+    def _number(self, root):
+        offsets = self.child_offsets
+        children = self.children
+        pre = self.pre
+        post = self.post
+        order = self.order
+
+        pre[root] = 0
+        order.append(root)
+        post_count = 0
+        stack = [[root, offsets[root]]]
+        while stack:
+            top = stack[-1]
+            p, k = top
+            if k < offsets[p + 1]:
+                top[1] = k + 1
+                child = children[k]
+
+                # A position that was already reached is part of a cycle.
+                if pre[child] < 0:
+                    pre[child] = len(order)
+                    order.append(child)
+                    stack.append([child, offsets[child]])
+            else:
+                post[p] = post_count
+                post_count += 1
+                stack.pop()
+
+    # Gives the children of p in position order.
+    def children_of(self, p):
+        return self.children[self.child_offsets[p]:self.child_offsets[p + 1]]
+
+    # Checks if a is an ancestor of b, or b itself, in constant time.
+    def is_ancestor(self, a, b):
+        return self.pre[a] >= 0 and self.pre[b] >= 0 and \
+               self.pre[a] <= self.pre[b] and self.post[b] <= self.post[a]
+
+    def __contains__(self, p):
+        return 0 <= p < len(self.pre) and self.pre[p] >= 0
+
+    # Yields the positions in the tree in pre-order.
+    def __iter__(self):
+        return iter(self.order)
 
-        for child in self.children:
-            s += child.size()
+    def __len__(self):
+        return len(self.order)
 
-        return s
+    # Yields every head and dependent pair of positions in the tree. The heads
+    # come in pre-order and the dependents of each head in position order.
+    def edges(self):
+        offsets = self.child_offsets
+        children = self.children
+        for head in self.order:
+            for k in xrange(offsets[head], offsets[head + 1]):
+                yield head, children[k]
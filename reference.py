@@ -0,0 +1,695 @@
+#!/usr/bin/env python
+
+################################################################################
+#
+# The reference model that bd.py checks a treebank against, which is how often
+# each pair of related words is annotated with each relationship in a set of
+# automatically parsed treebanks. A model is saved to a directory and memory
+# mapped when it is loaded, so it only has to be built once.
+#
+# Provide the model directory and then the automatically parsed treebanks, or
+# directories of them, to add to it. If the model already exists then only the
+# treebanks that are not already in it are parsed and added. A treebank of '-'
+# is read from stdin, and is always added since it can not be hashed. With -m,
+# the inputs are other model directories that are merged into the model instead.
+# As in bd.py, -p keys the model on morphological bundles and -w on forms, and
+# -j is the number of treebanks that are parsed at once.
+#
+################################################################################
+
+from array import array
+from collections import namedtuple
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+import consistency
+from lib.conll import *
+from lib.conll import _content_hash
+from lib.options import OptionsProcessor
+
+import numpy
+
+# Every relationship in a model has a direction, which is stored as its
+# position in DIRECTIONS.
+DIRECTIONS = (consistency.LEFT, consistency.RIGHT)
+
+# The fields of the words that a model can be keyed on.
+LEMMA_KEYS = 'lemma'
+FORM_KEYS = 'phon'
+MORPH_KEYS = 'morph'
+
+# The relationships that a pair of keys has in a context. counts has the number
+# of times each relationship was seen, and max_relation is the most frequent
+# one, which is the one that got to max_count first.
+Relationships = namedtuple('Relationships', ['counts', 'total', 'max_relation', 'max_count'])
+
+# An entry of a model is a pair of keys in a context as a tuple of ints, so that
+# it is hashed and compared without any Python code. It has the two keys in
+# order, where a pair of the same key has it twice, the relation of the head of
+# the pair, the lemma ids right before and after the pair, or -1 at either end
+# of the sentence, and then the tuple of lemma ids between the pair. The lemmas
+# outside and between the pair are its external and internal context.
+ENTRY_FIELDS = 5
+
+# Gets the keys of an entry as a set.
+def entry_keys(entry):
+    return frozenset(entry[:2])
+
+# Yields the position of the head and dependent, the entry and the relationship
+# of every head and dependent pair in the sentence, with the heads in
+# pre-order. The relationship is a tuple of the direction of the head and the
+# relation of the dependent.
+def sentence_nuclei(sentence, key_field):
+    words = sentence.words
+    n = len(words)
+    key_ids = [getattr(word, key_field + '_id') for word in words]
+    lemmas = tuple(word.lemma_id for word in words)
+    deps = [word.dep_id for word in words]
+
+    for h, c in SentenceTree(sentence).edges():
+        if h < c:
+            i = h
+            j = c
+            direction = consistency.LEFT
+        else:
+            i = c
+            j = h
+            direction = consistency.RIGHT
+
+        key1 = key_ids[h]
+        key2 = key_ids[c]
+        if key1 > key2:
+            key1, key2 = key2, key1
+
+        entry = (key1, key2, deps[h],
+                 lemmas[i - 1] if i > 0 else -1,
+                 lemmas[j + 1] if j + 1 < n else -1,
+                 lemmas[i + 1:j])
+
+        yield h, c, entry, (direction, deps[c])
+
+# Finds the Relationships from rows of a relationship, how often it was seen,
+# and when it was last seen. If no_word_order is set then the relationships are
+# only the relations of the dependents and their direction is dropped. The most
+# frequent relationship is the one whose count was reached first, which is the
+# one that was last seen the earliest.
+def _relationships(rows, no_word_order):
+    counts = {}
+    lasts = {}
+    for relationship, count, last in rows:
+        if no_word_order:
+            relationship = relationship[1]
+        counts[relationship] = counts.get(relationship, 0) + count
+        lasts[relationship] = max(lasts.get(relationship, 0), last)
+
+    max_relation = min(counts, key=lambda relationship: (-counts[relationship], lasts[relationship]))
+
+    return Relationships(counts, sum(counts.values()), max_relation, counts[max_relation])
+
+# A polynomial hash of an entry that does not depend on the platform, which
+# entries are sorted and looked up by.
+FINGERPRINT_BASE = 1000003
+FINGERPRINT_MODULUS = (1 << 61) - 1
+
+def _fingerprint(entry):
+    internal = entry[ENTRY_FIELDS]
+    h = len(internal)
+    for x in itertools.chain(entry[:ENTRY_FIELDS], internal):
+        h = (h * FINGERPRINT_BASE + x + 2) % FINGERPRINT_MODULUS
+
+    return h
+
+# Gets an entry with the ids of a vocabulary, where translation maps the ids it
+# has to those of the vocabulary. The keys are put back in order.
+def _translated_entry(translation, entry):
+    t = translation
+    key1, key2, head_dep, ext1, ext2, internal = entry
+    key1 = t[key1]
+    key2 = t[key2]
+    if key1 > key2:
+        key1, key2 = key2, key1
+
+    return (key1, key2, t[head_dep],
+            -1 if ext1 == -1 else t[ext1],
+            -1 if ext2 == -1 else t[ext2],
+            tuple(t[lemma] for lemma in internal))
+
+# Checks if the directory has a saved model in it.
+def is_model(directory):
+    return os.path.exists(os.path.join(directory, ReferenceModel.META))
+
+# A relationship as one integer, which is twice the relation of the dependent
+# plus the position of its direction in DIRECTIONS.
+def _encode_relationship(relationship):
+    direction, dep = relationship
+    return dep * 2 + DIRECTIONS.index(direction)
+
+def _decode_relationship(code):
+    return (DIRECTIONS[code & 1], code >> 1)
+
+# Groups rows that are sorted by their keys into runs of equal keys. Gives the
+# start of every run, and sums counts and takes the largest of lasts over each.
+def _reduce_runs(keys, counts, lasts):
+    if len(counts) == 0:
+        return numpy.zeros(0, dtype=numpy.int64), counts, lasts
+
+    changed = numpy.zeros(len(counts), dtype=bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    starts = numpy.flatnonzero(changed)
+
+    return starts, numpy.add.reduceat(counts, starts), numpy.maximum.reduceat(lasts, starts)
+
+# The totals, most frequent relationships and counts of every entry of a
+# ReferenceModel. The relationship rows of entry e are the rows from offsets[e]
+# to offsets[e + 1] of relations and counts, where a relation is either an
+# encoded relationship or only the relation of the dependent.
+Summary = namedtuple('Summary', ['offsets', 'relations', 'counts', 'totals', 'max_relations', 'max_counts'])
+
+# A reference model that is built in memory. Every relationship of each pair of
+# keys in a context has its count and the number of the edge it was last seen
+# on, where edges are numbered in the order they are added. Keeping when it
+# was last seen, rather than the most frequent relationship, means that models
+# can be merged as if their treebanks had been read one after the other.
+#
+# Each entry is numbered the first time it is seen, and every edge is only
+# recorded as a row of its entry and encoded relationship. The counts, lasts and
+# most frequent relationships are then found from all of the rows at once with
+# NumPy, rather than kept up to date in dicts edge by edge. Rows that were
+# already counted are kept sorted by entry and relationship in the arrays of
+# self.rows.
+#
+# The keys, contexts and relations are ids in vocab, and the keys are taken
+# from key_field of each word. sources has the content hash of every treebank
+# that was added, so that none is counted twice. Treebanks read from stdin or a
+# pipe can not be hashed, so they are always added and never in sources.
+class ReferenceModel(object):
+    META = 'meta.json'
+    VOCAB = 'vocab.txt'
+    ARRAYS = ('fingerprints', 'fields', 'internal_offsets', 'internal',
+              'relation_offsets', 'relations', 'counts', 'lasts')
+
+    def __init__(self, vocab, key_field=LEMMA_KEYS):
+        self.vocab = vocab
+        self.key_field = key_field
+        self.entry_ids = {}
+        self.entry_list = []
+        self.edges = 0
+        self.sources = []
+
+        # The entries and encoded relationships of the edges that are not
+        # counted yet, and the rows of counts and lasts from merged models.
+        self.edge_entries = array('l')
+        self.edge_relations = array('l')
+        self.edges_counted = 0
+        self.pending = []
+
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        self.rows = (empty, empty, empty, empty)
+        self.summaries = {}
+
+    # Adds every head and dependent pair of the sentence.
+    def add_sentence(self, sentence):
+        entry_ids = self.entry_ids
+        for h, c, entry, (direction, dep) in sentence_nuclei(sentence, self.key_field):
+            number = entry_ids.get(entry)
+            if number is None:
+                number = len(self.entry_list)
+                entry_ids[entry] = number
+                self.entry_list.append(entry)
+
+            self.edge_entries.append(number)
+            self.edge_relations.append(dep * 2 + (direction == consistency.RIGHT))
+
+        self.edges = self.edges_counted + len(self.edge_entries)
+
+    # Counts the edges and merged rows that are not counted yet. The edges are
+    # numbered after the ones that were counted before them.
+    def _count(self):
+        if not self.edge_entries and not self.pending:
+            return
+
+        n = len(self.edge_entries)
+        chunks = [self.rows]
+        if n:
+            chunks.append((numpy.array(self.edge_entries, dtype=numpy.int64),
+                           numpy.array(self.edge_relations, dtype=numpy.int64),
+                           numpy.ones(n, dtype=numpy.int64),
+                           numpy.arange(self.edges_counted + 1, self.edges_counted + n + 1, dtype=numpy.int64)))
+        chunks.extend(self.pending)
+
+        entries, relations, counts, lasts = [numpy.concatenate(column) for column in zip(*chunks)]
+        order = numpy.lexsort((relations, entries))
+        entries = entries[order]
+        relations = relations[order]
+        starts, counts, lasts = _reduce_runs((entries, relations), counts[order], lasts[order])
+        self.rows = (entries[starts], relations[starts], counts, lasts)
+
+        self.edges_counted = self.edges
+        self.edge_entries = array('l')
+        self.edge_relations = array('l')
+        self.pending = []
+        self.summaries = {}
+
+    # Finds the Summary of every entry, where the relations are only those of
+    # the dependents if no_word_order is set. Since the rows are sorted by
+    # encoded relationship, the rows of each relation of a dependent are next
+    # to each other. The most frequent relationship of an entry is the one
+    # with the highest count that was last seen the earliest.
+    def _summary(self, no_word_order):
+        self._count()
+        if no_word_order in self.summaries:
+            return self.summaries[no_word_order]
+
+        entries, relations, counts, lasts = self.rows
+        if no_word_order:
+            relations = relations >> 1
+            starts, counts, lasts = _reduce_runs((entries, relations), counts, lasts)
+            entries = entries[starts]
+            relations = relations[starts]
+
+        n = len(self.entry_list)
+        offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(numpy.bincount(entries, minlength=n))
+        totals = numpy.bincount(entries, weights=counts, minlength=n).astype(numpy.int64)
+
+        best = numpy.lexsort((lasts, -counts, entries))
+        firsts = best[offsets[:-1][offsets[:-1] < offsets[1:]]]
+        max_relations = numpy.zeros(n, dtype=numpy.int64)
+        max_counts = numpy.zeros(n, dtype=numpy.int64)
+        max_relations[entries[firsts]] = relations[firsts]
+        max_counts[entries[firsts]] = counts[firsts]
+
+        summary = Summary(offsets, relations, counts, totals, max_relations, max_counts)
+        self.summaries[no_word_order] = summary
+
+        return summary
+
+    # Adds every sentence of the treebank file unless it is already in the
+    # model. Returns if the treebank was added.
+    def add_treebank(self, filename):
+        return self._add_treebank(filename, _source_hash(filename))
+
+    def _add_treebank(self, filename, h):
+        if h is not None and h in self.sources:
+            return False
+
+        for sentence in TreeBank(self.vocab).genr(filename):
+            self.add_sentence(sentence)
+        if h is not None:
+            self.sources.append(h)
+
+        return True
+
+    # Adds the treebank files in order, and yields each filename along with if
+    # it was added. With more than one job, each treebank is counted in its own
+    # ReferenceModel in a pool of worker processes, whose ReferenceTables are
+    # merged in order, so the result is the same as adding them one at a time.
+    # Worker processes can not read stdin, so stdin and the other treebanks that
+    # are not regular files are added here when their turn comes.
+    def add_treebanks(self, filenames, jobs=1):
+        filenames = list(filenames)
+        if jobs <= 1:
+            for filename in filenames:
+                yield filename, self.add_treebank(filename)
+            return
+
+        pool = multiprocessing.Pool(jobs, _init_worker, (self.key_field, frozenset(self.sources)))
+        try:
+            tables = pool.imap(_treebank_table, [filename for filename in filenames
+                                                 if is_regular_file(filename)])
+            for filename in filenames:
+                if not is_regular_file(filename):
+                    yield filename, self.add_treebank(filename)
+                    continue
+
+                table = tables.next()
+                if table is None or set(table.sources) & set(self.sources):
+                    yield filename, False
+                else:
+                    self._merge_table(table)
+                    yield filename, True
+        finally:
+            pool.close()
+            pool.join()
+
+    # Adds the counts of another model, built or loaded with the same
+    # vocabulary, as if its treebanks came after the ones in this model.
+    def merge(self, other):
+        if other.key_field != self.key_field:
+            raise ValueError('Can not merge a model keyed on {} into one keyed on {}'.format(other.key_field, self.key_field))
+        if set(other.sources) & set(self.sources):
+            raise ValueError('The models have treebanks in common')
+
+        # The edges of this model have to be counted first so that they are
+        # numbered before those of the other model.
+        self._count()
+
+        entries = array('l')
+        relations = array('l')
+        counts = array('l')
+        lasts = array('l')
+        for entry, rows in other.entries():
+            number = self.entry_ids.get(entry)
+            if number is None:
+                number = len(self.entry_list)
+                self.entry_ids[entry] = number
+                self.entry_list.append(entry)
+
+            for relationship, count, last in rows:
+                entries.append(number)
+                relations.append(_encode_relationship(relationship))
+                counts.append(count)
+                lasts.append(last + self.edges)
+
+        self.pending.append(tuple(numpy.array(column, dtype=numpy.int64)
+                                  for column in (entries, relations, counts, lasts)))
+        self.edges += other.edges
+        self.edges_counted = self.edges
+        self.sources.extend(other.sources)
+
+    # Merges a ReferenceTable in the same way. Its ids are translated into the
+    # vocabulary of this model with array lookups and its rows are added as
+    # they are, so the only work done in Python is to number its entries.
+    def _merge_table(self, table):
+        if table.key_field != self.key_field:
+            raise ValueError('Can not merge a model keyed on {} into one keyed on {}'.format(table.key_field, self.key_field))
+        if set(table.sources) & set(self.sources):
+            raise ValueError('The models have treebanks in common')
+
+        self._count()
+
+        # The last id of the translation is the one for -1, which stays as it
+        # is, and the keys of every entry are put back in order.
+        translation = numpy.array([self.vocab.intern(symbol) for symbol in table.symbols] + [-1],
+                                  dtype=numpy.int64)
+        fields = translation[table.fields]
+        fields[:, :2].sort(axis=1)
+        internal = translation[table.internal].tolist()
+        internal_offsets = table.internal_offsets.tolist()
+
+        numbers = array('l')
+        for k, entry_fields in enumerate(fields.tolist()):
+            entry = tuple(entry_fields) + (tuple(internal[internal_offsets[k]:internal_offsets[k + 1]]),)
+            number = self.entry_ids.get(entry)
+            if number is None:
+                number = len(self.entry_list)
+                self.entry_ids[entry] = number
+                self.entry_list.append(entry)
+            numbers.append(number)
+        numbers = numpy.array(numbers, dtype=numpy.int64)
+
+        entries, relations, counts, lasts = table.rows
+        relations = translation[relations >> 1] * 2 + (relations & 1)
+        self.pending.append((numbers[entries], relations, counts, lasts + self.edges))
+        self.edges += table.edges
+        self.edges_counted = self.edges
+        self.sources.extend(table.sources)
+
+    # Yields every entry along with the rows of the relationship, count and
+    # last edge of each of its relationships.
+    def entries(self):
+        self._count()
+        entries, relations, counts, lasts = [column.tolist() for column in self.rows]
+
+        start = 0
+        while start < len(entries):
+            end = start
+            while end < len(entries) and entries[end] == entries[start]:
+                end += 1
+
+            yield self.entry_list[entries[start]], [(_decode_relationship(relations[k]), counts[k], lasts[k])
+                                  for k in xrange(start, end)]
+            start = end
+
+    # Gets the Relationships of the entry, or None if it was never seen.
+    def relationships(self, entry, no_word_order):
+        number = self.entry_ids.get(entry)
+        if number is None:
+            return None
+
+        summary = self._summary(no_word_order)
+        start = summary.offsets[number]
+        end = summary.offsets[number + 1]
+        if start == end:
+            return None
+
+        if no_word_order:
+            decode = int
+        else:
+            decode = _decode_relationship
+        counts = dict((decode(relation), count) for relation, count in
+                      itertools.izip(summary.relations[start:end].tolist(), summary.counts[start:end].tolist()))
+
+        return Relationships(counts, int(summary.totals[number]),
+                             decode(int(summary.max_relations[number])), int(summary.max_counts[number]))
+
+    # Writes the model to the directory as arrays that can be memory mapped.
+    # The entries are sorted by their fingerprint, and the relationships of
+    # the i-th entry are the rows from relation_offsets[i] to
+    # relation_offsets[i + 1] of relations, counts and lasts. Each file is
+    # written next to the one it replaces and then moved over it, so that a
+    # model that is memory mapped is never changed under it. The metadata is
+    # written last so that a partially written model is never used.
+    def save(self, directory):
+        rows = [(_fingerprint(entry), entry, relationships) for entry, relationships in self.entries()]
+        rows.sort(key=lambda row: row[0])
+
+        arrays = dict((name, []) for name in ReferenceModel.ARRAYS)
+        arrays['internal_offsets'].append(0)
+        arrays['relation_offsets'].append(0)
+        for fingerprint, entry, relationships in rows:
+            arrays['fingerprints'].append(fingerprint)
+            arrays['fields'].append(entry[:ENTRY_FIELDS])
+            arrays['internal'].extend(entry[ENTRY_FIELDS])
+            arrays['internal_offsets'].append(len(arrays['internal']))
+            for (direction, dep), count, last in sorted(relationships):
+                arrays['relations'].append((DIRECTIONS.index(direction), dep))
+                arrays['counts'].append(count)
+                arrays['lasts'].append(last)
+            arrays['relation_offsets'].append(len(arrays['counts']))
+
+        dtypes = {
+            'fingerprints': numpy.uint64,
+            'fields': numpy.int32,
+            'internal': numpy.int32,
+            'relations': numpy.int32
+        }
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        meta_path = os.path.join(directory, ReferenceModel.META)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+
+        for name in ReferenceModel.ARRAYS:
+            a = numpy.array(arrays[name], dtype=dtypes.get(name, numpy.int64))
+            if name == 'fields':
+                a = a.reshape((len(rows), ENTRY_FIELDS))
+            elif name == 'relations':
+                a = a.reshape((len(arrays['counts']), 2))
+            _replace(os.path.join(directory, name + '.npy'), lambda f: numpy.save(f, a))
+
+        def write_vocab(f):
+            for symbol in self.vocab.symbols:
+                f.write(symbol + '\n')
+        _replace(os.path.join(directory, ReferenceModel.VOCAB), write_vocab)
+
+        meta = {
+            'key_field': self.key_field,
+            'edges': self.edges,
+            'sources': self.sources
+        }
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+# The counts of a ReferenceModel as arrays, along with the symbols of its
+# vocabulary, which is how a model built in a worker process is sent back. The
+# entries are laid out as in a saved model, with the first ENTRY_FIELDS fields
+# of the i-th entry in fields[i] and its internal context from
+# internal_offsets[i] to internal_offsets[i + 1] of internal. The rows are those
+# of the model, and only need their ids translated to be merged into another.
+class ReferenceTable(object):
+    def __init__(self, model):
+        model._count()
+        self.key_field = model.key_field
+        self.edges = model.edges
+        self.sources = model.sources
+        self.symbols = model.vocab.symbols
+        self.rows = model.rows
+
+        entry_list = model.entry_list
+        self.fields = numpy.array([entry[:ENTRY_FIELDS] for entry in entry_list],
+                                  dtype=numpy.int64).reshape((len(entry_list), ENTRY_FIELDS))
+        self.internal = numpy.fromiter(itertools.chain.from_iterable(entry[ENTRY_FIELDS] for entry in entry_list),
+                                       dtype=numpy.int64)
+        self.internal_offsets = numpy.zeros(len(entry_list) + 1, dtype=numpy.int64)
+        self.internal_offsets[1:] = numpy.cumsum([len(entry[ENTRY_FIELDS]) for entry in entry_list])
+
+# The key field and the content hashes of the treebanks already in the model in
+# a worker process. These are set once when the worker starts rather than sent
+# along with every treebank.
+_worker_key_field = None
+_worker_sources = None
+
+def _init_worker(key_field, sources):
+    global _worker_key_field, _worker_sources
+    _worker_key_field = key_field
+    _worker_sources = sources
+
+# Counts one treebank in a worker process, or gives back None if it is already
+# in the model.
+def _treebank_table(filename):
+    h = _source_hash(filename)
+    if h is not None and h in _worker_sources:
+        return None
+
+    model = ReferenceModel(Vocabulary(), _worker_key_field)
+    model._add_treebank(filename, h)
+
+    return ReferenceTable(model)
+
+# The content hash of a treebank file, or None if it is not a regular file and
+# so can only be read once.
+def _source_hash(filename):
+    if not is_regular_file(filename):
+        return None
+
+    return _content_hash(filename)
+
+# Writes a file through write and then moves it over path.
+def _replace(path, write):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.rename(tmp_path, path)
+
+# A reference model that was saved to a directory, whose arrays are memory
+# mapped rather than read. The ids in the arrays are only those of vocab if its
+# symbols were interned in the same order as in the model, which is the case
+# when the model is loaded into an empty vocabulary, and identity tells if they
+# are. If not, the ids are translated as the entries are read, and the model
+# can only be used through entries.
+class MappedReferenceModel(object):
+    def __init__(self, directory, vocab):
+        with open(os.path.join(directory, ReferenceModel.META), 'r') as f:
+            meta = json.load(f)
+        self.key_field = str(meta['key_field'])
+        self.edges = meta['edges']
+        self.sources = [str(source) for source in meta['sources']]
+
+        with open(os.path.join(directory, ReferenceModel.VOCAB), 'r') as f:
+            symbols = f.read().split('\n')[:-1]
+        self.translation = [vocab.intern(symbol) for symbol in symbols]
+        self.identity = self.translation == range(len(symbols))
+
+        for name in ReferenceModel.ARRAYS:
+            setattr(self, name, numpy.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def _rows(self, k):
+        relations = self.relations[self.relation_offsets[k]:self.relation_offsets[k + 1]].tolist()
+        counts = self.counts[self.relation_offsets[k]:self.relation_offsets[k + 1]].tolist()
+        lasts = self.lasts[self.relation_offsets[k]:self.relation_offsets[k + 1]].tolist()
+        t = self.translation
+
+        return [((DIRECTIONS[direction], t[dep]), count, last)
+                for (direction, dep), count, last in itertools.izip(relations, counts, lasts)]
+
+    def _entry(self, k):
+        internal = self.internal[self.internal_offsets[k]:self.internal_offsets[k + 1]]
+
+        return tuple(self.fields[k].tolist()) + (tuple(internal.tolist()),)
+
+    # Yields every entry along with the rows of the relationship, count and
+    # last edge of each of its relationships, with their ids in the vocabulary
+    # the model was loaded into.
+    def entries(self):
+        for k in xrange(len(self)):
+            yield _translated_entry(self.translation, self._entry(k)), self._rows(k)
+
+    # Gets the Relationships of the entry, or None if it was never seen. The
+    # entry is found by a binary search on the fingerprints, and is then
+    # compared in case of collisions.
+    def relationships(self, entry, no_word_order):
+        fingerprint = numpy.uint64(_fingerprint(entry))
+
+        k = self.fingerprints.searchsorted(fingerprint)
+        while k < len(self) and self.fingerprints[k] == fingerprint:
+            if self._entry(k) == entry:
+                return _relationships(self._rows(k), no_word_order)
+            k += 1
+
+        return None
+
+# Loads the model saved in the directory with the ids of vocab. It is memory
+# mapped if its ids line up with the vocabulary, and otherwise it is read into a
+# ReferenceModel.
+def load_model(directory, vocab):
+    mapped = MappedReferenceModel(directory, vocab)
+    if mapped.identity:
+        return mapped
+
+    model = ReferenceModel(vocab, mapped.key_field)
+    model.merge(mapped)
+
+    return model
+
+# Gets the treebank files at a path, which is either a treebank or a directory
+# of them.
+def _treebank_files(path):
+    if os.path.isdir(path):
+        return [os.path.join(path, filename) for filename in sorted(os.listdir(path))]
+    else:
+        return [path]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        raise TypeError('Give the model directory and at least one input')
+
+    op = OptionsProcessor()
+    op.add_option(('-m', '--merge'), 'merge')
+    op.add_option(('-p', '--morph'), 'morph')
+    op.add_option(('-w', '--words'), 'words')
+    op.add_value_option(('-j', '--jobs'), 'jobs', 1)
+
+    op.process(sys.argv)
+
+    if op.morph_present():
+        key_field = MORPH_KEYS
+    elif op.words_present():
+        key_field = FORM_KEYS
+    else:
+        key_field = LEMMA_KEYS
+
+    directory = sys.argv[1]
+    inputs = [arg for i, arg in enumerate(sys.argv[2:], 2)
+              if (arg == STDIN or not arg.startswith('-')) and
+              sys.argv[i - 1] not in ('-j', '--jobs')]
+
+    # The model that is already saved is read into memory so that it can be
+    # added to and then saved over.
+    vocab = Vocabulary()
+    model = ReferenceModel(vocab, key_field)
+    if is_model(directory):
+        model.merge(MappedReferenceModel(directory, vocab))
+
+    if op.merge_present():
+        for path in inputs:
+            print path
+            model.merge(MappedReferenceModel(path, vocab))
+    else:
+        filenames = itertools.chain.from_iterable(_treebank_files(path) for path in inputs)
+        for filename, added in model.add_treebanks(filenames, int(op.jobs_value())):
+            if added:
+                print filename
+            else:
+                print '{} is already in the model'.format(filename)
+
+    model.save(directory)
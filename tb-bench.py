@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+################################################################################
+#
+# A benchmark of how fast TreeBank files are read. Provide the filenames as
+# input. For each file, every sentence is read with TreeBank.genr, then read
+# again while touching the word fields that consistency.py uses, then while
+# only reading and touching the lemmas, and then while interning every word in
+# a Vocabulary. The throughput of each is output in sentences per second.
+#
+################################################################################
+
+from __future__ import division
+
+import sys
+import time
+
+from lib.conll import TreeBank, Vocabulary
+
+def _touch_fields(sentences):
+    for sentence in sentences:
+        for word in sentence.words:
+            word.index, word.phon, word.lemma, word.dep_index, word.dep
+
+        yield sentence
+
+def _touch_lemmas(sentences):
+    for sentence in sentences:
+        for word in sentence.words:
+            word.lemma
+
+        yield sentence
+
+def _bench(label, sentences):
+    start = time.time()
+    count = 0
+    for sentence in sentences:
+        count += 1
+    elapsed = time.time() - start
+
+    print('{: <12}{} sentences in {:.2f}s, {:.0f} sentences/s'.format(label, count, elapsed, count / elapsed))
+
+if len(sys.argv) < 2:
+    raise TypeError('Have to benchmark at least one file!')
+
+for fn in sys.argv[1:]:
+    print(fn)
+    _bench('genr', TreeBank().genr(fn))
+    _bench('fields', _touch_fields(TreeBank().genr(fn)))
+    _bench('lemmas', _touch_lemmas(TreeBank().genr(fn, ('lemma',))))
+    _bench('interned', TreeBank(Vocabulary()).genr(fn))
@@ -9,7 +9,7 @@
 #
 ################################################################################
 
-from lib.conll import TreeBank
+from lib.conll import ColumnarTreeBank, TreeBank
 
 import os
 import sys
@@ -18,14 +18,20 @@ if len(sys.argv) < 2:
     raise TypeError('Have to count at least one file!')
 
 filenames = sys.argv[1:]
-tb = TreeBank()
 
 s_count = 0
 t_count = 0
 for fn in filenames:
-    for sentence in tb.genr(fn):
-        s_count += 1
-        t_count += len(sentence.words)
+    # If a file has been cached, the counts come from the cached columns.
+    # Otherwise the file is scanned for counts without parsing any sentences.
+    tb = ColumnarTreeBank()
+    if tb.from_cache(fn):
+        s_count += len(tb)
+        t_count += len(tb.forms)
+    else:
+        sentences, tokens = TreeBank().count(fn)
+        s_count += sentences
+        t_count += tokens
 
 print('{} sentences'.format(s_count))
 print('{} tokens'.format(t_count))